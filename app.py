@@ -2,9 +2,12 @@ import dash
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 import dash_html_components as html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 
 import argparse
+import flask
+import logging
+import uuid
 
 from smap.features.defaults import TimeUsage
 
@@ -12,33 +15,118 @@ from smap.ordering.OLOSeriation import OLOSeriation
 from smap.ordering.SOMClustering import SOMClustering
 from smap.ordering.TSPSeriation import TSPSeriation
 
-from smap.smap import create_smap, get_smap
+from smap.geometry import LEVELS
+from smap.instrumentation import profiler
+from smap.jobs import JobRunner
+from smap.smap import DEFAULT_DATASET, create_smap, get_smap, registry
 
-from smap.maps import get_seriation_map
+from smap.maps import get_seriation_map, map_layout
 
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
+runner = JobRunner()
+
+@app.server.route('/stats')
+def stats():
+    # Time spent per stage and cache counters since the start (empty unless --profile is given)
+    return flask.jsonify(profiler.stats())
+
+def compute_map(method, radius, dataset, progress):
+    # With a sample rate, an approximate map is shown first, then refined by the exact one
+    with profiler.request(f'map dataset={dataset} radius={radius} method={method}'):
+        if args.sample_rate is not None and not get_smap(dataset).has_feature_df(radius):
+            figures = get_seriation_map(ordering_methods[method], radius,
+                                        lambda p, m='': progress(p / 2, m), dataset, args.sample_rate)
+            progress(0.5, 'Refining the map', partial=figures)
+            return get_seriation_map(ordering_methods[method], radius,
+                                     lambda p, m='': progress(0.5 + p / 2, m), dataset)
+        return get_seriation_map(ordering_methods[method], radius, progress, dataset)
+
+@app.callback(
+    Output('job', 'data'),
+    Input('dataset-dropdown', 'value'),
+    Input('radius-input', 'value'),
+    Input('method-dropdown', 'value'),
+    State('session', 'data'))
+def start_map(dataset, radius, method, session):
+    # The map is computed in background, the page polls the job until it is done
+    if dataset is None or radius is None or method is None:
+        return dash.no_update
+    runner.submit((dataset, radius, method), compute_map, method, radius, dataset, channel=session)
+    return [dataset, radius, method]
 
 @app.callback(
     Output('map', 'figure'),
     Output('heatmap', 'figure'),
-    Input('radius-input', 'value'),
-    Input('method-dropdown', 'value'))
-def update_map(radius, method):
-    smap = get_smap()
-    smap.radius = radius
-    fig_map, fig_hm = get_seriation_map(ordering_methods[method])
-    return fig_map, fig_hm
+    Output('progress', 'value'),
+    Output('progress', 'children'),
+    Output('poll', 'disabled'),
+    Output('approximate', 'data'),
+    Input('poll', 'n_intervals'),
+    Input('job', 'data'),
+    State('approximate', 'data'))
+def update_map(_, key, shown):
+    # The approximate map of a job is sent once, shown is the key of the job it was sent for
+    job = runner.get(tuple(key)) if key is not None else None
+    if job is None:
+        return dash.no_update, dash.no_update, 0, '', True, None
+    if not job.done():
+        if job.partial is not None and shown != key:
+            fig_map, fig_hm = job.partial
+            return fig_map, fig_hm, 100*job.progress, job.message, False, key
+        return dash.no_update, dash.no_update, 100*job.progress, job.message, False, shown
+    if job.cancelled:
+        return dash.no_update, dash.no_update, 0, '', True, None
+    if job.future.exception() is not None:
+        return dash.no_update, dash.no_update, 100, f'Error: {job.future.exception()}', True, None
+    fig_map, fig_hm = job.result()
+    return fig_map, fig_hm, 100, '', True, None
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('traj_file', help='Filepath to the trajectory file')
-    parser.add_argument('region_file', help='Filepath to the file with regions')
+    parser.add_argument('traj_file', nargs='?', help='Filepath to the trajectory file')
+    parser.add_argument('region_file', nargs='?', help='Filepath to the file with regions')
     parser.add_argument('--poi_file', help='Filepath to the POI file')
+    parser.add_argument('--chunksize', type=int,
+                        help='Number of trajectory rows read at once (default: whole file), the rows of each id must '
+                             'be contiguous or ordered by time')
+    parser.add_argument('--precompute_radii', type=int, nargs='+', help='Radii whose features are computed in background at startup')
+    parser.add_argument('--cache_memory', type=int, default=2**30, help='Memory budget (in bytes) of the per-radius caches')
+    parser.add_argument('--neighbor_method', choices=['exact', 'centroid'], default='exact',
+                        help='Distance between regions: between their polygons or their centroids')
+    parser.add_argument('--n_jobs', type=int, default=1, help='Number of processes used to aggregate the trajectories')
+    parser.add_argument('--cache_orders', action='store_true',
+                        help='Also store the orders of the regions on disk, they are then reused after a restart')
+    parser.add_argument('--cache_columns', action='store_true',
+                        help='Cache the feature columns on disk so that adding a feature only computes its column')
+    parser.add_argument('--geometry_level', choices=list(LEVELS), default='medium',
+                        help='Simplification level of the regions drawn on the map')
+    parser.add_argument('--dataset', nargs='+', action='append', default=[],
+                        metavar=('NAME', 'TRAJ_FILE REGION_FILE [POI_FILE]'),
+                        help='Additional dataset, loaded the first time it is displayed')
+    parser.add_argument('--sample_rate', type=float,
+                        help='Show first a map whose features are approximated on this fraction of the ids')
+    parser.add_argument('--profile', action='store_true',
+                        help='Log the time spent in each stage of every request and serve the totals on /stats')
 
     args = parser.parse_args()
-    create_smap(args.traj_file, args.region_file, args.poi_file, [TimeUsage()])
-    smap = get_smap()
+    if args.profile:
+        logging.basicConfig(level=logging.INFO)
+        profiler.enable()
+    datasets = [[DEFAULT_DATASET, args.traj_file, args.region_file, args.poi_file]] if args.traj_file else []
+    for d in args.dataset:
+        if len(d) not in (3, 4):
+            parser.error('--dataset expects a name, a trajectory file, a region file and optionally a POI file')
+        datasets.append(d + [None]*(4 - len(d)))
+    if not datasets:
+        parser.error('no dataset given')
+    for i, (name, traj_file, region_file, poi_file) in enumerate(datasets):
+        # Each dataset has its own features as their values depend on the data
+        create_smap(traj_file, region_file, poi_file, [TimeUsage()], chunksize=args.chunksize,
+                    precompute_radii=args.precompute_radii, cache_memory=args.cache_memory,
+                    neighbor_method=args.neighbor_method, n_jobs=args.n_jobs,
+                    cache_columns=args.cache_columns, cache_orders=args.cache_orders, geometry_level=args.geometry_level,
+                    name=name, lazy=i > 0)
 
     # Does not work now :(
     #ordering_methods = [cls() for cls in OrderingMethod.__subclasses__()]
@@ -47,9 +135,23 @@ if __name__ == '__main__':
     ordering_methods = {x.name: x for x in ordering_methods}
 
 
-    app.layout = html.Div([
+    # The token and the map layout are read once, before the first request
+    map_layout()
+
+    # The layout is a function so that each page gets its own session, the rest is built once
+    static_layout = [
+        dcc.Store(id='job'),
+        dcc.Store(id='approximate'),
+        dcc.Interval(id='poll', interval=500, disabled=True),
         html.H1(children='Seriation map'),
         dbc.Row([
+            dbc.Col(
+                dcc.Dropdown(
+                    id='dataset-dropdown',
+                    options=[{'label': x, 'value': x} for x in registry.names()],
+                    value=registry.names()[0]
+                ),
+                width=3),
             dbc.Col(['Radius: ', dcc.Input(id='radius-input', value=10, type='number')],
                     width=4),
             dbc.Col(
@@ -60,10 +162,12 @@ if __name__ == '__main__':
                 )
             )
         ]),
+        dbc.Progress(id='progress', value=0),
         dbc.Row([
             dbc.Col(dcc.Graph(id='heatmap'), className='col-6'),
             dbc.Col(dcc.Graph(id='map'), className='col-6')
         ]),
-    ])
+    ]
+    app.layout = lambda: html.Div([dcc.Store(id='session', data=str(uuid.uuid4()))] + static_layout)
 
     app.run_server(debug=True)
@@ -0,0 +1,51 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+from scipy.spatial.distance import euclidean
+
+from benchmarks.bench_seriation import make_features
+from benchmarks.synthetic import timeit
+from smap.coloring.Colors import interpolate, rgb_to_str, str_to_rgb
+from smap.coloring.Colorscale import get_colorscale
+from smap.coloring.path import path_distances
+
+
+def legacy_colorscale(df, order, colors):
+    # Path distances and colorscale as computed by get_seriation_map before they were vectorized
+    distances = [0.0] + [euclidean(df.iloc[order[i-1]], df.iloc[order[i]]) for i in range(1, len(order))]
+    total_distance = sum(distances)
+    props = [0.0 for _ in distances]
+    for i in range(1, len(props)):
+        props[i] = min(1.0, props[i-1] + (distances[i]/total_distance))
+    divs = np.linspace(0, 1, len(colors))
+    c1_idx = 0
+    c2_idx = 1
+    colorscale = list()
+    for prop in props:
+        if prop >= divs[c2_idx]:
+            c1_idx += 1
+            c2_idx += 1
+        if c1_idx == len(divs)-1:
+            colorscale.append((1.0, rgb_to_str(colors[-1])))
+        else:
+            alpha = (prop - divs[c1_idx])/(divs[c2_idx] - divs[c1_idx])
+            colorscale.append((prop, rgb_to_str(interpolate(colors[c1_idx], colors[c2_idx], alpha))))
+    rounded = [(round(x,2),y) for x,y in colorscale]
+    return [x for i, x in enumerate(rounded) if i == 0 or x != rounded[i-1]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Path distances and colorscale of a seriation map')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 50_000])
+    args = parser.parse_args()
+
+    colors = [str_to_rgb(x) for i, x in enumerate(px.colors.sequential.Rainbow) if i not in {1,3,6}]
+    print(f'{"regions":>10} {"legacy (s)":>12} {"vectorized (s)":>16} {"speedup":>9}')
+    for n in args.sizes:
+        df = pd.DataFrame(make_features(n))
+        order = np.random.default_rng(0).permutation(n)
+        old = timeit(lambda: legacy_colorscale(df, order, colors))
+        new = timeit(lambda: get_colorscale(path_distances(df.to_numpy(), order), colors))
+        print(f'{n:>10} {old:>12.3f} {new:>16.4f} {old/new:>8.0f}x')
@@ -0,0 +1,40 @@
+import argparse
+import time
+
+import geopandas as gpd
+
+from benchmarks.synthetic import make_labels, make_regions, make_trajectories, timeit
+from smap.regions import RegionIndex
+
+
+def legacy_locate(df, regions, labels):
+    # Point in region assignment as done by Smap._aggregate_chunk before the region index
+    df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df['lon'], df['lat']), crs=regions.crs)
+    df = gpd.sjoin(df, regions, predicate='within').rename(columns={'index_right': 'region_id'})
+    df = gpd.sjoin(df, labels, predicate='within', how='left')
+    return df.sort_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput of the point in region assignment')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000_000, 10_000_000])
+    parser.add_argument('--grid', type=int, nargs=2, default=[40, 40], metavar=('NX', 'NY'))
+    parser.add_argument('--legacy_max', type=int, default=2_000_000,
+                        help='Largest size on which the sjoin implementation is run')
+    args = parser.parse_args()
+
+    regions = make_regions(*args.grid)
+    labels = make_labels(regions)
+    start = time.perf_counter()
+    index = RegionIndex(regions, labels)
+    print(f'index of {len(regions)} regions and {len(labels)} labels built in {time.perf_counter() - start:.2f} s')
+
+    print(f'{"points":>12} {"sjoin (pts/s)":>16} {"index (pts/s)":>16} {"speedup":>9}')
+    for n in args.sizes:
+        data = make_trajectories(n, max(1, n // 1000))
+        new = timeit(lambda: index.locate(data['lon'].to_numpy(), data['lat'].to_numpy()))
+        if n <= args.legacy_max:
+            old = timeit(lambda: legacy_locate(data, regions, labels))
+            print(f'{n:>12} {n/old:>16.0f} {n/new:>16.0f} {old/new:>8.1f}x')
+        else:
+            print(f'{n:>12} {"-":>16} {n/new:>16.0f} {"-":>9}')
@@ -0,0 +1,141 @@
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from benchmarks.synthetic import make_labels, make_regions, make_trajectories
+from smap.features.defaults import Distance, TimeUsage, Velocity
+from smap.ordering.OLOSeriation import OLOSeriation
+from smap.ordering.SOMClustering import SOMClustering
+from smap.ordering.TSPSeriation import TSPSeriation
+from smap.smap import create_smap, get_smap
+from smap.trajectories import segment_trips
+
+ORDERING_METHODS = {
+    'olo': OLOSeriation,
+    'tsp': lambda: TSPSeriation(solver='heuristic'),
+    'som': SOMClustering,
+}
+
+
+class Recorder:
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = list()
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        # Wall time and peak of the memory allocated during the stage
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        record = {'name': name, 'seconds': seconds, 'rows': rows,
+                  'rows_per_second': rows / seconds if rows is not None and seconds > 0 else None}
+        if self.trace_memory:
+            record['peak_memory'] = tracemalloc.get_traced_memory()[1] - base
+        self.stages.append(record)
+        print(f'{name:<30} {seconds:>10.3f} s', flush=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.realpath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, workdir):
+    rec = Recorder(not args.no_memory)
+    if rec.trace_memory:
+        tracemalloc.start()
+
+    traj_file = os.path.join(workdir, 'traj.csv')
+    regions_file = os.path.join(workdir, 'regions.geojson')
+    labels_file = os.path.join(workdir, 'labels.geojson') if args.label_fraction > 0 else None
+    with rec.stage('generate', args.points):
+        regions = make_regions(*args.grid)
+        regions.to_file(regions_file, driver='GeoJSON')
+        if labels_file is not None:
+            make_labels(regions, args.label_fraction, seed=args.seed).to_file(labels_file, driver='GeoJSON')
+        make_trajectories(args.points, args.ids, seed=args.seed).to_csv(traj_file, index=False)
+
+    # End to end construction, then each of its stages on its own
+    with rec.stage('build', args.points):
+        create_smap(traj_file, regions_file, labels_file, [TimeUsage(), Velocity(), Distance()],
+                    cache_dir=os.path.join(workdir, 'cached'), cache_orders=False)
+    smap = get_smap()
+    with rec.stage('csv_load', args.points):
+        df = pd.read_csv(traj_file, parse_dates=[smap.timestamp_field])
+    with rec.stage('segmentation', len(df)):
+        df = segment_trips(df, smap.id_field, smap.timestamp_field, smap.lat_field, smap.lon_field)
+    with rec.stage('sjoin', len(df)):
+        df = smap._aggregator._locate(df)
+    with rec.stage('features', len(df)):
+        smap._aggregator._compute_features(df)
+    with rec.stage('pre_aggregation', len(df)):
+        smap._finalize_aggregates([smap._aggregator._pre_aggregate(df)])
+
+    for radius in args.radii:
+        with rec.stage(f'feature_df[radius={radius}]', len(smap.regions)):
+            smap.get_feature_df(radius)
+    data = smap.get_feature_df(args.radii[0]).drop(columns='region_id')
+    for name in args.methods:
+        with rec.stage(f'ordering[{name}]', len(data)):
+            ORDERING_METHODS[name]().get_order(data)
+
+    from smap.maps import get_seriation_map
+    for name in args.methods:
+        with rec.stage(f'seriation_map[{name}]', len(data)):
+            get_seriation_map(ORDERING_METHODS[name](), args.radii[0])
+    for name in args.methods:
+        with rec.stage(f'seriation_map_cached[{name}]', len(data)):
+            get_seriation_map(ORDERING_METHODS[name](), args.radii[0])
+
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'config': {'points': args.points, 'ids': args.ids, 'grid': args.grid, 'labels': args.label_fraction,
+                   'radii': args.radii, 'methods': args.methods, 'seed': args.seed},
+        'regions': len(smap.regions),
+        'pairs': len(smap.pre_features),
+        'stages': rec.stages,
+        # ru_maxrss is in kilobytes on Linux
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End to end benchmark of a seriation map on synthetic data')
+    parser.add_argument('--points', type=int, default=200_000)
+    parser.add_argument('--ids', type=int, default=2_000)
+    parser.add_argument('--grid', type=int, nargs=2, default=[30, 30], metavar=('NX', 'NY'))
+    parser.add_argument('--label_fraction', type=float, default=0.05, help='Fraction of the regions with a label')
+    parser.add_argument('--radii', type=int, nargs='+', default=[0, 5, 10])
+    parser.add_argument('--methods', nargs='+', choices=list(ORDERING_METHODS), default=list(ORDERING_METHODS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no_memory', action='store_true', help='Do not trace the memory (lower overhead)')
+    parser.add_argument('--output', help='JSON file of the results (default: standard output)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run(args, workdir)
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,38 @@
+import argparse
+
+import numpy as np
+
+from benchmarks.synthetic import make_trajectories, timeit
+from smap.trajectories import segment_trips
+
+
+def legacy_segmentation(df, id_field, timestamp_field):
+    # Trip segmentation as done by Smap._compute_pre_dataframe before it was vectorized
+    df.sort_values(by=[id_field, timestamp_field], inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    df['duration'] = (df[timestamp_field].shift(-1).fillna(df.loc[len(df)-1, timestamp_field]) -
+                      df[timestamp_field])/np.timedelta64(1, 's')
+    switch = [df.loc[i, id_field] != df.loc[i+1, id_field] for i in range(len(df)-1)] + [False]
+    df.loc[switch, 'duration'] = 0
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput of the trip segmentation')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000_000, 10_000_000])
+    parser.add_argument('--points_per_id', type=int, default=1000)
+    parser.add_argument('--legacy_max', type=int, default=10_000_000,
+                        help='Largest size on which the legacy implementation is run')
+    args = parser.parse_args()
+
+    print(f'{"points":>12} {"legacy (pts/s)":>16} {"vectorized (pts/s)":>20} {"speedup":>9}')
+    for n in args.sizes:
+        data = make_trajectories(n, max(1, n // args.points_per_id))
+        # The input is shuffled so that the sort is part of what is measured
+        data = data.sample(frac=1, random_state=0)
+        new = timeit(lambda df: segment_trips(df, 'id', 'daytime', 'lat', 'lon'), data.copy())
+        if n <= args.legacy_max:
+            old = timeit(lambda df: legacy_segmentation(df, 'id', 'daytime'), data.copy())
+            print(f'{n:>12} {n/old:>16.0f} {n/new:>20.0f} {old/new:>8.1f}x')
+        else:
+            print(f'{n:>12} {"-":>16} {n/new:>20.0f} {"-":>9}')
@@ -0,0 +1,52 @@
+import argparse
+import time
+
+import numpy as np
+from sklearn.preprocessing import normalize
+
+from smap.ordering.OLOSeriation import OLOSeriation
+
+
+def make_features(n_regions, n_features=8, seed=0):
+    # Regions spread along a smooth curve in feature space with some noise, as neighboring
+    # regions of a map tend to have similar features
+    rng = np.random.default_rng(seed)
+    t = rng.random(n_regions)
+    freqs = rng.uniform(0.5, 3, size=n_features)
+    phases = rng.uniform(0, 2*np.pi, size=n_features)
+    features = 1.5 + np.sin(np.outer(t, freqs) * 2*np.pi + phases)
+    return features + rng.normal(0, 0.05, size=features.shape)
+
+
+def path_length(data, order):
+    norm_data = normalize(data, norm='l2')[order]
+    return np.linalg.norm(np.diff(norm_data, axis=0), axis=1).sum()
+
+
+def run(method, data):
+    start = time.perf_counter()
+    order = method.get_order(data)
+    elapsed = time.perf_counter() - start
+    assert sorted(order) == list(range(len(data)))
+    return elapsed, path_length(data, order)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exact vs scalable optimal leaf ordering')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 2_000, 10_000, 50_000])
+    parser.add_argument('--exact_max', type=int, default=2_000,
+                        help='Largest size on which the exact method is run (O(n^2) memory and about O(n^3) time)')
+    parser.add_argument('--cluster_size', type=int, default=500)
+    args = parser.parse_args()
+
+    exact = OLOSeriation(max_exact=float('inf'))
+    scalable = OLOSeriation(max_exact=args.cluster_size, cluster_size=args.cluster_size)
+    print(f'{"regions":>8} {"exact (s)":>10} {"exact length":>13} {"scalable (s)":>13} {"scalable length":>16} {"ratio":>6}')
+    for n in args.sizes:
+        data = make_features(n)
+        s_time, s_len = run(scalable, data)
+        if n <= args.exact_max:
+            e_time, e_len = run(exact, data)
+            print(f'{n:>8} {e_time:>10.2f} {e_len:>13.2f} {s_time:>13.2f} {s_len:>16.2f} {s_len/e_len:>6.2f}')
+        else:
+            print(f'{n:>8} {"-":>10} {"-":>13} {s_time:>13.2f} {s_len:>16.2f} {"-":>6}')
@@ -0,0 +1,56 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def timeit(f, *args):
+    # Seconds taken by f(*args)
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def make_trajectories(n_points, n_ids, seed=0, bounds=(2.5, 49.5, 6.4, 51.5),
+                      id_field='id', lat='lat', lon='lon', timestamp='daytime'):
+    # Random walks of n_ids vehicles with n_points fixes in total, sorted by id then time. Roughly
+    # a third of the fixes are stops so that every time usage category shows up.
+    rng = np.random.default_rng(seed)
+    ids = np.sort(rng.integers(0, n_ids, size=n_points))
+    starts = rng.uniform(bounds[:2], bounds[2:], size=(n_ids, 2))
+
+    steps = rng.normal(0, 0.003, size=(n_points, 2))
+    steps[rng.random(n_points) < 0.3] *= 0.01
+    first = np.ones(n_points, dtype=bool)
+    first[1:] = ids[1:] != ids[:-1]
+    steps[first] = starts[ids[first]]
+    # cumsum runs over the whole array, what was accumulated before each trip is removed
+    pos = np.cumsum(steps, axis=0)
+    starts_idx = np.flatnonzero(first)
+    pos -= (pos[starts_idx] - steps[starts_idx])[np.cumsum(first) - 1]
+    pos = np.clip(pos, bounds[:2], bounds[2:])
+
+    seconds = np.cumsum(rng.integers(5, 900, size=n_points))
+    seconds -= seconds[starts_idx][np.cumsum(first) - 1]
+    times = pd.Timestamp('2021-01-01') + pd.to_timedelta(seconds, unit='s')
+    return pd.DataFrame({id_field: ids, lat: pos[:, 1], lon: pos[:, 0], timestamp: times})
+
+
+def make_regions(nx, ny, bounds=(2.5, 49.5, 6.4, 51.5)):
+    # Grid of nx * ny rectangular regions covering bounds
+    import geopandas as gpd
+    from shapely import box
+
+    x = np.linspace(bounds[0], bounds[2], nx + 1)
+    y = np.linspace(bounds[1], bounds[3], ny + 1)
+    xx, yy = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+    xx, yy = xx.ravel(), yy.ravel()
+    return gpd.GeoDataFrame(geometry=box(x[xx], y[yy], x[xx + 1], y[yy + 1]), crs='EPSG:4326')
+
+
+def make_labels(regions, fraction=0.05, labels=('depot', 'port'), seed=0):
+    # Labelled areas (e.g. depots) in a random fraction of the regions, a quarter of their size
+    rng = np.random.default_rng(seed)
+    chosen = regions.iloc[np.flatnonzero(rng.random(len(regions)) < fraction)]
+    return chosen.assign(geometry=chosen.geometry.scale(0.5, 0.5), label=rng.choice(labels, len(chosen)))\
+        .reset_index(drop=True)
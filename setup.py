@@ -7,14 +7,15 @@ install_requires = [
     "pandas>=1.2.2",
     "geopandas>=0.9.0",
     "rtree>=0.9.7",
+    "shapely>=2.1",
     "scipy>=1.6.1",
     "scikit-learn>=0.24.1",
     "dash>=1.19.0",
     "dash-bootstrap-components>=0.11.3",
     "psutil>=5.8.0",
+    "pyarrow>=3.0.0",
     "requests>=2.25.1",
     "kaleido>=0.2.1",
-    "minisom>=2.2.8",
     "seriate>=1.1.2"
 ]
 
@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from smap.cache import file_fingerprint, shared
+from smap.instrumentation import stage
+from smap.regions import RegionIndex
+from smap.trajectories import NEXT_LAT, NEXT_LON, segment_trips
+
+
+def neighbors_matrix(regions, neighbors, n_regions):
+    # Binary (region x region) matrix with a 1 where the second region is in the neighborhood of the first
+    m = sparse.csr_matrix((np.ones(len(regions)), (regions, neighbors)), shape=(n_regions, n_regions))
+    m.sum_duplicates()
+    m.data[:] = 1.0
+    return m
+
+
+def neighborhood_features(neighbors, region_codes, id_codes, values, categorical, max_nonzeros=2**20):
+    # Computes, for every region, the features of its neighborhood from the pre-aggregated values
+    # of each (id, region) pair (one row of values per pair).
+    #
+    # For each region and each id seen in its neighborhood, the categorical columns are summed
+    # and normalized by their total while the numerical columns are averaged over the regions of
+    # the neighborhood. The ids with a total of 0 are dropped and the value of the region is the
+    # mean over the remaining ids. The (region, id) sums are done by multiplying the neighbors
+    # matrix with a (region x (id, column)) matrix, by batches of neighborhoods whose product has
+    # about max_nonzeros entries.
+    # neighbors may only have the rows of some regions, its columns are all the regions
+    neighbors = sparse.csr_matrix(neighbors)
+    n_regions = neighbors.shape[0]
+    n_ids = int(id_codes.max()) + 1 if len(id_codes) > 0 else 0
+    n_cols = values.shape[1]
+
+    # values may be sparse, only its non zero entries are summed. The sums are done in float64.
+    values = sparse.coo_matrix(values)
+    rows = np.concatenate([region_codes[values.row], region_codes])
+    cols = np.concatenate([id_codes[values.row] + n_ids * values.col.astype(np.int64),
+                           id_codes + n_ids * n_cols])
+    data = np.concatenate([values.data.astype(float), np.ones(len(region_codes))])
+    per_id = sparse.csr_matrix((data, (rows, cols)), shape=(neighbors.shape[1], n_ids * (n_cols + 1)))
+
+    # Upper bound of the entries of each row of the product
+    sizes = neighbors @ np.diff(per_id.indptr).astype(float)
+    bounds = np.searchsorted(np.cumsum(sizes), np.arange(1, int(sizes.sum() // max_nonzeros) + 1) * max_nonzeros)
+    bounds = np.unique(np.concatenate([[0], bounds, [n_regions]]))
+
+    features = np.full((n_regions, n_cols), np.nan)
+    if n_ids == 0:
+        return features
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        features[start:end] = _batch_features(neighbors[start:end] @ per_id, n_ids, n_cols, categorical)
+    return features
+
+
+def _batch_features(sums, n_ids, n_cols, categorical):
+    sums = sums.tocoo()
+    column, ids = np.divmod(sums.col, n_ids)
+    keys = sums.row.astype(np.int64) * n_ids + ids
+
+    # The last column counts the pairs of each (region, id), it gives the (region, id) seen
+    seen = column == n_cols
+    pairs = keys[seen]
+    order = np.argsort(pairs)
+    pairs, counts = pairs[order], sums.data[seen][order]
+    rows = pairs // n_ids
+    agg = np.zeros((len(pairs), n_cols))
+    agg[np.searchsorted(pairs, keys[~seen]), column[~seen]] = sums.data[~seen]
+
+    agg[:, ~categorical] /= counts[:, None]
+    if categorical.any():
+        total = agg[:, categorical].sum(axis=1)
+        keep = total != 0
+        rows, agg, total = rows[keep], agg[keep], total[keep]
+        agg[:, categorical] /= total[:, None]
+
+    n = np.bincount(rows, minlength=sums.shape[0])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.column_stack([np.bincount(rows, weights=agg[:, j], minlength=sums.shape[0]) / n
+                                for j in range(n_cols)])
+
+
+class ChunkAggregator:
+
+    def __init__(self, regions, labelized_regions, regions_file, labelized_regions_file, pipeline,
+                 id_field, lat_field, lon_field, timestamp_field):
+        # Pre-aggregates chunks of trajectories into (id, region) pairs. It is what the worker
+        # processes get of a smap.
+        self.regions = regions
+        self.labelized_regions = labelized_regions
+        self.regions_file = regions_file
+        self.labelized_regions_file = labelized_regions_file
+        self.pipeline = pipeline
+        self.features = pipeline.features
+        self.id_field = id_field
+        self.lat_field = lat_field
+        self.lon_field = lon_field
+        self.timestamp_field = timestamp_field
+        self._index = None
+
+    def aggregate(self, df, fingerprint=None):
+        with stage('segmentation', len(df)):
+            df = segment_trips(df, self.id_field, self.timestamp_field, self.lat_field, self.lon_field)
+        with stage('sjoin', len(df)):
+            df = self._locate(df)
+        with stage('features', len(df)):
+            self._compute_features(df, fingerprint)
+        with stage('pre_aggregation', len(df)):
+            return self._pre_aggregate(df)
+
+    def _locate(self, df):
+        # Region (and predefined label) of each point, the points outside the regions are dropped
+        points, regions, labels = self.region_index().locate(df[self.lon_field], df[self.lat_field])
+        df = df.take(points)
+        df.reset_index(drop=True, inplace=True)
+        df['region_id'] = self.regions.index[regions]
+        if self.labelized_regions is not None:
+            # -1 (no label) picks the '' appended at the end
+            values = np.append(self.labelized_regions['label'].to_numpy(dtype=object), '')
+            df['label'] = values[labels]
+        return df
+
+    def region_index(self):
+        # Built once and shared by the smaps using the same files. Once built, it is part of the
+        # aggregator given to the worker processes, they do not build it again.
+        if self._index is None:
+            self._index = shared(['region index', file_fingerprint(self.regions_file),
+                                  file_fingerprint(self.labelized_regions_file)],
+                                 lambda: RegionIndex(self.regions, self.labelized_regions))
+        return self._index
+
+    def _compute_features(self, df, fingerprint=None):
+        kwargs = dict(lat=self.lat_field, lon=self.lon_field, next_lat=NEXT_LAT, next_lon=NEXT_LON)
+        if self.labelized_regions is not None:
+            kwargs['predefined_labels'] = df['label']
+        self.pipeline.run(df, fingerprint, **kwargs)
+
+        cols_to_keep = [self.id_field, 'region_id', 'duration'] + [f.name for f in self.features]
+        df.drop(df.columns.difference(cols_to_keep), axis=1, inplace=True)
+
+    def _pre_aggregate(self, df):
+        categorical_features = [f for f in self.features if f.categorical]
+        numerical_features = [f.name for f in self.features if not f.categorical]
+
+        to_merge = list()
+        # Each numerical feature is summed and counted per id and per BSU, the mean is
+        # taken once all the chunks are merged
+        if len(numerical_features) != 0:
+            num_df = df.groupby([self.id_field, 'region_id'])[numerical_features].agg(['sum', 'count'])
+            num_df.columns = [name if agg == 'sum' else f'{name} count' for name, agg in num_df.columns]
+            to_merge.append(num_df)
+
+        # Then we handle the catagorical feature separately and merge them afterward
+        for feat in categorical_features:
+            durations = df.groupby([self.id_field, 'region_id', feat.name], observed=True)['duration'].sum().unstack()
+            durations.columns = durations.columns.astype(str).rename(None)
+            to_merge.append(durations)
+
+        return pd.concat(to_merge, axis=1)
@@ -0,0 +1,161 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from scipy import sparse
+
+from smap.instrumentation import count
+
+
+def file_fingerprint(path):
+    if path is None:
+        return None
+    st = os.stat(path)
+    return [os.path.realpath(path), st.st_size, st.st_mtime_ns]
+
+
+def hash_key(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def write_table(path, df, metadata=None):
+    write_arrow(path, pa.Table.from_pandas(df, preserve_index=False), metadata)
+
+
+def read_table(path):
+    table, metadata = read_arrow(path)
+    return table.to_pandas(split_blocks=True), metadata
+
+
+def write_arrow(path, table, metadata=None):
+    # Tables are stored uncompressed in the Arrow IPC format so that they can be memory mapped
+    # back without any decoding
+    if metadata is not None:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                               b'smap': json.dumps(metadata).encode()})
+    tmp = f'{path}.tmp'
+    with pa.OSFile(tmp, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, path)
+
+
+def read_arrow(path):
+    table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    metadata = table.schema.metadata.get(b'smap') if table.schema.metadata is not None else None
+    return table, (json.loads(metadata) if metadata is not None else None)
+
+
+def nbytes(obj):
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(np.sum(obj.memory_usage(deep=True)))
+    if sparse.issparse(obj):
+        obj = obj.tocsr()
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(nbytes(x) for x in obj)
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    return 0
+
+
+class LRUCache:
+
+    def __init__(self, max_items=None, max_bytes=None, name=None):
+        # A named cache counts its hits and misses ('<name> hit', '<name> miss') in the profiler
+        self.max_items = max_items
+        self.name = name
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._sizes = dict()
+        self._bytes = 0
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        with self._lock:
+            return list(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._remove(key)
+            self._items[key] = value
+            self._sizes[key] = nbytes(value) if self.max_bytes is not None else 0
+            self._bytes += self._sizes[key]
+            # The least recently used items are evicted, but never the one that was just added
+            while len(self._items) > 1 and ((self.max_items is not None and len(self._items) > self.max_items) or
+                                            (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                self._remove(next(iter(self._items)))
+
+    def pop(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            self._remove(key)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def get_or_compute(self, key, compute):
+        # Concurrent calls for the same key wait for the first one instead of computing the value again
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                if self.name is not None:
+                    count(f'{self.name} hit')
+                return self._items[key]
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = threading.Event()
+        if owner and self.name is not None:
+            count(f'{self.name} miss')
+        if not owner:
+            pending.wait()
+            return self.get_or_compute(key, compute)
+        try:
+            value = compute()
+            self.put(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.set()
+
+    def _remove(self, key):
+        if key in self._items:
+            del self._items[key]
+            self._bytes -= self._sizes.pop(key)
+
+
+# Objects shared by all the smaps of the process, e.g. the geometries of a regions file used by
+# several datasets. They are built on first use and must not be modified.
+_shared = LRUCache()
+
+
+def shared(key, build):
+    return _shared.get_or_compute(hash_key(key), build)
@@ -1,27 +1,20 @@
 import numpy as np
-from smap.coloring.Colors import Color, color_to_rgb_scale, interpolate, rgb_to_str
+from smap.coloring.Colors import Color, rgb_to_str
 
-def get_colorscale(distances: list[float], colors: list[Color]):
-    total_distance = sum(distances)
-    props = [0.0 for _ in distances]
-    for i in range(1, len(props)):
-        props[i] = min(1.0, props[i-1] + (distances[i]/total_distance))
+def get_colorscale(distances: list[float], colors: list[Color], n_stops: int = 101):
+    # Colorscale over the ranks of a path: the color at a rank is taken at the proportion of the
+    # total distance traveled to reach it, so large jumps in the path are large color changes.
+    # The scale is sampled at n_stops evenly spaced ranks.
+    cumulative = np.cumsum(np.asarray(distances, dtype=float))
+    n = len(cumulative)
+    if cumulative[-1] > 0:
+        props = np.minimum(1.0, cumulative / cumulative[-1])
+    else:
+        props = np.linspace(0, 1, n)
+    positions = np.linspace(0, 1, max(2, min(n_stops, n)))
+    props = np.interp(positions * (n - 1), np.arange(n), props)
 
+    colors = np.asarray(colors, dtype=float)
     divs = np.linspace(0, 1, len(colors))
-    c1_idx = 0
-    c2_idx = 1
-    colorscale = list()
-    for prop in props:
-        if prop >= divs[c2_idx]:
-            c1_idx += 1
-            c2_idx += 1
-        if c1_idx == len(divs)-1:
-            colorscale.append((1.0, rgb_to_str(colors[-1])))
-        else:
-            alpha = (prop - divs[c1_idx])/(divs[c2_idx] - divs[c1_idx])
-            c = interpolate(colors[c1_idx], colors[c2_idx], alpha)
-            colorscale.append((prop, rgb_to_str(c)))
-    print(colorscale[:5])
-    rounded = [(round(x,2),y) for x,y in colorscale]
-    rounded = [x for i, x in enumerate(rounded) if i == 0 or x != rounded[i-1]]
-    return rounded
+    rgb = np.column_stack([np.interp(props, divs, colors[:, i]) for i in range(3)]).astype(int)
+    return [(p, rgb_to_str(c)) for p, c in zip(positions.round(4).tolist(), rgb.tolist())]
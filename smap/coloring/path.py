@@ -0,0 +1,14 @@
+import numpy as np
+
+
+def path_distances(data, order):
+    # Distance between each region of the path and the previous one, 0 for the first region
+    steps = np.diff(np.asarray(data, dtype=float)[order], axis=0)
+    return np.concatenate([[0.0], np.linalg.norm(steps, axis=1)])
+
+
+def ranks(order):
+    # Position of each region in the path
+    r = np.empty(len(order), dtype=int)
+    r[order] = np.arange(len(order))
+    return r
@@ -7,18 +7,6 @@ from abc import ABCMeta, abstractmethod
 
 class Feature(metaclass=ABCMeta):
 
-    _instance = None
-
-    def __new__(cls):
-        if cls._instance is None:
-            print(f'Creating object {cls}')
-            cls._instance = super(Feature, cls).__new__(cls)
-        return cls._instance
-
-    def add_dependencies(self, data, **kwargs):
-        for f in self.dependencies:
-            f.compute(data, **kwargs)
-
     @property
     @abstractmethod
     def name(self) -> str:
@@ -36,8 +24,19 @@ class Feature(metaclass=ABCMeta):
 
     @abstractmethod
     def compute(self, data: pd.DataFrame, **kwargs):
+        # Adds the column of the feature to data. The columns of the dependencies are already
+        # computed (see FeaturePipeline)
         pass
 
+    @property
+    def params(self) -> dict:
+        return {}
+
+    @property
+    def key(self) -> list:
+        # Identifies the computation of a feature: its parameters and the ones of its dependencies
+        return [self.name, self.params, [f.key for f in self.dependencies]]
+
 
 class NumericalFeature(Feature):
 
@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 
 from smap.features import NumericalFeature, CategoricalFeature
 from smap.features.utils import haversine
@@ -9,14 +10,12 @@ class Distance(NumericalFeature):
     dependencies = []
 
     def compute(self, data, **kwargs):
-        if self.name not in data.columns:
-            self.add_dependencies(data, **kwargs)
-            lat = kwargs['lat']
-            lon = kwargs['lon']
-            data[self.name] = haversine(data[lon].shift(-1).fillna(data.loc[len(data)-1, lon]),
-                                        data[lat].shift(-1).fillna(data.loc[len(data)-1, lat]),
-                                        data[lon],
-                                        data[lat])
+        lat = kwargs['lat']
+        lon = kwargs['lon']
+        data[self.name] = haversine(data[kwargs['next_lon']],
+                                    data[kwargs['next_lat']],
+                                    data[lon],
+                                    data[lat])
 
 class Velocity(NumericalFeature):
 
@@ -24,11 +23,9 @@ class Velocity(NumericalFeature):
     dependencies = [Distance()]
 
     def compute(self, data, **kwargs):
-        if self.name not in data.columns:
-            self.add_dependencies(data, **kwargs)
-            dist = data[Distance().name]
-            durs = data['duration']
-            data[self.name] = dist / (durs / 3600)
+        dist = data[Distance.name]
+        durs = data['duration']
+        data[self.name] = dist / (durs / 3600)
 
 class TimeUsage(CategoricalFeature):
 
@@ -37,24 +34,30 @@ class TimeUsage(CategoricalFeature):
 
     values = ['congestion', 'work', 'driving']
 
+    def __init__(self, velocity_threshold=15, duration_threshold=600):
+        # The predefined labels are added to the values of each instance
+        self.values = list(self.values)
+        self.velocity_threshold = velocity_threshold
+        self.duration_threshold = duration_threshold
+
+    @property
+    def params(self):
+        return {'velocity_threshold': self.velocity_threshold, 'duration_threshold': self.duration_threshold}
+
     def compute(self, data, **kwargs):
-        if self.name not in data.columns:
-            self.add_dependencies(data, **kwargs)
-            if 'predefined_labels' in kwargs:
-                for val in kwargs['predefined_labels']:
-                    if val != '' and val not in self.values:
-                        self.values.append(val)
-            velocity = data[Velocity().name]
-            duration = data['duration']
-            predefined_labels = kwargs['predefined_labels'] if 'predefined_labels' in kwargs else [np.nan for _ in range(len(data))]
-
-            def type(idx):
-                if velocity[idx] <= 15:
-                    if duration[idx] < 600:
-                        return 'congestion'
-                    if predefined_labels[idx] != '':
-                        return predefined_labels[idx]
-                    return 'work'
-                return 'driving'
-
-            data[self.name] = [type(i) for i in range(len(data))]
+        velocity = data[Velocity.name].to_numpy()
+        duration = data['duration'].to_numpy()
+
+        # The first matching condition gives the label, slow points that are not congestion
+        # are labelled as work unless they are in a predefined region
+        conditions = [~(velocity <= self.velocity_threshold), duration < self.duration_threshold]
+        choices = ['driving', 'congestion']
+        if 'predefined_labels' in kwargs:
+            predefined_labels = np.asarray(kwargs['predefined_labels'], dtype=object)
+            for val in pd.unique(predefined_labels):
+                if val != '' and val not in self.values:
+                    self.values.append(val)
+            conditions.append(predefined_labels != '')
+            choices.append(predefined_labels)
+
+        data[self.name] = pd.Categorical(np.select(conditions, choices, default='work'), categories=self.values)
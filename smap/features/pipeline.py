@@ -0,0 +1,59 @@
+import os
+
+from smap.cache import hash_key, read_table, write_table
+
+
+class FeaturePipeline:
+
+    def __init__(self, features, cache_dir=None):
+        self.features = features
+        self.cache_dir = cache_dir
+
+    def steps(self):
+        # Features of the pipeline and their dependencies in topological order. A feature used by
+        # several others (same name and parameters) is computed only once.
+        order = list()
+        done = dict()
+        visiting = set()
+
+        def visit(f):
+            key = hash_key(f.key)
+            if key in done:
+                return
+            if key in visiting:
+                raise ValueError(f"Cyclic dependency on feature '{f.name}'")
+            visiting.add(key)
+            for dep in f.dependencies:
+                visit(dep)
+            visiting.remove(key)
+            if f.name in done.values():
+                raise ValueError(f"Two configurations of the feature '{f.name}' in the same pipeline")
+            done[key] = f.name
+            order.append(f)
+
+        for f in self.features:
+            visit(f)
+        return order
+
+    def run(self, data, fingerprint=None, **kwargs):
+        # Adds a column per feature to data. If a fingerprint of the data is given and a cache
+        # directory is set, the columns are cached on disk per fingerprint and feature.
+        for f in self.steps():
+            filename = self._column_file(f, fingerprint)
+            if filename is not None and os.path.exists(filename):
+                column, _ = read_table(filename)
+                data[f.name] = column[f.name].to_numpy() if not f.categorical else column[f.name].values
+                if f.categorical:
+                    for v in data[f.name].cat.categories:
+                        if v not in f.values:
+                            f.values.append(v)
+            else:
+                f.compute(data, **kwargs)
+                if filename is not None:
+                    os.makedirs(os.path.dirname(filename), exist_ok=True)
+                    write_table(filename, data[[f.name]])
+
+    def _column_file(self, f, fingerprint):
+        if self.cache_dir is None or fingerprint is None:
+            return None
+        return os.path.join(self.cache_dir, fingerprint, f'{hash_key(f.key)[:16]}.arrow')
@@ -0,0 +1,65 @@
+import json
+import os
+
+import numpy as np
+import shapely
+
+from smap.cache import file_fingerprint, hash_key
+
+# Simplification tolerances of the GeoJSON levels, in degrees. When the regions form a valid
+# coverage (no overlaps), their shared borders are simplified once so that neighboring regions
+# keep sharing them. Otherwise each polygon is simplified on its own.
+LEVELS = {
+    'full': 0.0,
+    'medium': 1e-4,
+    'low': 1e-3,
+}
+
+
+class GeoJSONExport:
+
+    def __init__(self, regions, regions_file=None, cache_dir=None, levels=LEVELS, digits=5):
+        # The GeoJSON of every level is built (or read from the cache) once, and the same dict is
+        # then returned for every request
+        self.levels = dict(levels)
+        self.digits = digits
+        if regions.crs is not None and not regions.crs.equals('EPSG:4326'):
+            regions = regions.to_crs('EPSG:4326')
+        source = file_fingerprint(regions_file) if regions_file is not None else\
+            shapely.to_wkb(regions.geometry.values).tolist()
+        self._geojson = dict()
+        for level, tolerance in self.levels.items():
+            key = hash_key(source, tolerance, digits, 'coverage')
+            filename = os.path.join(cache_dir, f'geojson-{level}-{key[:16]}.json') if cache_dir is not None else None
+            if filename is not None and os.path.exists(filename):
+                with open(filename) as f:
+                    self._geojson[level] = json.load(f)
+                continue
+            self._geojson[level] = self._export(regions, tolerance)
+            if filename is not None:
+                with open(f'{filename}.tmp', 'w') as f:
+                    json.dump(self._geojson[level], f, separators=(',', ':'))
+                os.replace(f'{filename}.tmp', filename)
+
+    def get(self, level):
+        if level not in self._geojson:
+            raise ValueError(f'Unknown geometry level {level}, expected one of {list(self._geojson)}')
+        return self._geojson[level]
+
+    def _export(self, regions, tolerance):
+        geoms = regions.geometry.values
+        if tolerance > 0:
+            if shapely.coverage_is_valid(geoms):
+                geoms = shapely.coverage_simplify(geoms, tolerance)
+            else:
+                geoms = shapely.simplify(geoms, tolerance, preserve_topology=True)
+        # Coordinates are snapped on a grid so that they are written with few digits, the regions
+        # that would collapse keep their original geometry
+        grid = 10.0**-self.digits
+        snapped = shapely.set_precision(geoms, grid)
+        geoms = np.where(shapely.is_empty(snapped), geoms, snapped)
+        geoms = shapely.transform(geoms, lambda c: np.round(c, self.digits))
+        features = [{'type': 'Feature', 'id': str(i), 'properties': {}, 'geometry': shapely.geometry.mapping(g)}
+                    for i, g in zip(regions.index, geoms)]
+        # Round trip so that a fresh export and one read from the cache are the same lists and dicts
+        return json.loads(json.dumps({'type': 'FeatureCollection', 'features': features}))
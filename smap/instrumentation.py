@@ -0,0 +1,138 @@
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import logging
+import os
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger('smap')
+
+# Returned by stage() when profiling is disabled, the record it yields is a throwaway dict
+_NOOP = nullcontext({})
+
+
+def current_rss():
+    # Resident memory of the process in bytes, None when it cannot be measured
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class Profiler:
+
+    def __init__(self):
+        # Disabled by default: stage() then returns a shared no-op context and count() returns
+        # immediately, so instrumented code only pays an attribute lookup and a call
+        self.enabled = False
+        self.memory = False
+        self._callbacks = list()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def enable(self, memory=True):
+        # memory measures the RSS delta of each stage
+        self.memory = memory and current_rss() is not None
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._stages = defaultdict(lambda: {'calls': 0, 'seconds': 0.0, 'rows': 0, 'memory': 0})
+            self._counters = defaultdict(int)
+
+    def add_callback(self, callback):
+        # callback(record) is called at the end of every stage
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self._callbacks.remove(callback)
+
+    def stage(self, name, rows=None):
+        # The context yields the record of the stage, whose rows can be set within the stage
+        if not self.enabled:
+            return _NOOP
+        return self._stage(name, rows)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] += n
+        requests = getattr(self._local, 'requests', None)
+        if requests:
+            requests[-1]['counters'][name] += n
+
+    @contextmanager
+    def request(self, name):
+        # Collects the stages and counters of the current thread and logs them on one line
+        if not self.enabled:
+            yield None
+            return
+        if not hasattr(self._local, 'requests'):
+            self._local.requests = list()
+        current = {'name': name, 'stages': list(), 'counters': defaultdict(int)}
+        self._local.requests.append(current)
+        start = time.perf_counter()
+        try:
+            yield current
+        finally:
+            self._local.requests.pop()
+            current['seconds'] = time.perf_counter() - start
+            logger.info(format_request(current))
+
+    def stats(self):
+        with self._lock:
+            return {'stages': {k: dict(v) for k, v in self._stages.items()}, 'counters': dict(self._counters)}
+
+    @contextmanager
+    def _stage(self, name, rows):
+        record = {'name': name, 'rows': rows, 'memory': None}
+        rss = current_rss() if self.memory else None
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            if rss is not None:
+                record['memory'] = current_rss() - rss
+            with self._lock:
+                total = self._stages[name]
+                total['calls'] += 1
+                total['seconds'] += record['seconds']
+                total['rows'] += record['rows'] or 0
+                total['memory'] += record['memory'] or 0
+            requests = getattr(self._local, 'requests', None)
+            if requests:
+                requests[-1]['stages'].append(record)
+            for callback in self._callbacks:
+                callback(record)
+
+
+def format_request(request):
+    parts = [f'{request["name"]}: {request["seconds"]:.3f}s']
+    for s in request['stages']:
+        part = f'{s["name"]} {s["seconds"]:.3f}s'
+        if s['rows'] is not None:
+            part += f' {s["rows"]} rows'
+        if s['memory'] is not None:
+            part += f' {s["memory"] / 2**20:+.1f}MB'
+        parts.append(part)
+    parts += [f'{k}={v}' for k, v in sorted(request['counters'].items())]
+    return ' | '.join(parts)
+
+
+profiler = Profiler()
+stage = profiler.stage
+count = profiler.count
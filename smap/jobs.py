@@ -0,0 +1,126 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from smap.cache import LRUCache
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+
+    def __init__(self, key):
+        self.key = key
+        self.progress = 0.0
+        self.message = ''
+        # Intermediate result (e.g. an approximation) the job may report before its result
+        self.partial = None
+        self.future = None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def failed(self):
+        return self.done() and not self.future.cancelled() and self.future.exception() is not None
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def cancel(self):
+        # Running jobs are cancelled cooperatively, the next call to report stops them. Returns
+        # whether the job was cancelled before it started.
+        self._cancelled.set()
+        return self.future.cancel()
+
+    def report(self, progress, message='', partial=None):
+        if self.cancelled:
+            raise JobCancelled(self.key)
+        self.progress = progress
+        self.message = message
+        if partial is not None:
+            self.partial = partial
+
+
+class JobRunner:
+
+    def __init__(self, max_workers=2, keep_done=16):
+        # The function of a job is called with the job's report method as its progress argument.
+        # A channel (e.g. a browser session) follows one job at a time: submitting a new job on a
+        # channel cancels the previous one if no other channel follows it.
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._lock = threading.Lock()
+        self._running = dict()
+        self._done = LRUCache(keep_done)
+        self._followers = dict()
+        self._channels = dict()
+
+    def submit(self, key, fn, *args, channel=None, **kwargs):
+        with self._lock:
+            job = self._done.get(key)
+            if job is None:
+                job = self._running.get(key)
+            if job is None or job.cancelled or job.failed():
+                job = Job(key)
+                self._running[key] = job
+                job.future = self._executor.submit(self._run, job, fn, *args, **kwargs)
+            if channel is not None:
+                self._follow(channel, key)
+            return job
+
+    def get(self, key):
+        with self._lock:
+            job = self._running.get(key)
+            return job if job is not None else self._done.get(key)
+
+    def shutdown(self):
+        with self._lock:
+            for job in self._running.values():
+                job.cancel()
+            self._running.clear()
+        self._executor.shutdown(wait=True)
+
+    def _follow(self, channel, key):
+        previous = self._channels.get(channel)
+        if previous == key:
+            return
+        self._channels[channel] = key
+        self._followers.setdefault(key, set()).add(channel)
+        if previous is None:
+            return
+        followers = self._followers.get(previous, set())
+        followers.discard(channel)
+        if not followers:
+            self._followers.pop(previous, None)
+            if previous in self._running and self._running[previous].cancel():
+                del self._running[previous]
+
+    def _run(self, job, fn, *args, **kwargs):
+        try:
+            result = fn(*args, progress=job.report, **kwargs)
+        except JobCancelled:
+            # Cancelled jobs are forgotten so that they are run again when requested
+            with self._lock:
+                self._forget(job)
+            raise
+        except BaseException:
+            # Failed jobs are kept so that their error can be read, they are run again when submitted
+            with self._lock:
+                self._forget(job)
+                self._done.put(job.key, job)
+            raise
+        job.progress = 1.0
+        with self._lock:
+            self._forget(job)
+            self._done.put(job.key, job)
+        return result
+
+    def _forget(self, job):
+        # A cancelled job may have been replaced by a new one with the same key
+        if self._running.get(job.key) is job:
+            del self._running[job.key]
@@ -1,74 +1,129 @@
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 
+from functools import lru_cache
 import json
-from scipy.spatial.distance import euclidean
-from sklearn.preprocessing import QuantileTransformer
+import os
+import numpy as np
 
+from smap.cache import hash_key
 from smap.coloring.Colorscale import get_colorscale
 from smap.coloring.Colors import str_to_rgb
+from smap.coloring.path import path_distances, ranks
+from smap.instrumentation import stage
 from smap.smap import get_smap
 
+# Above this number of regions, the rows of the heatmap are averaged by bins of consecutive regions
+HEATMAP_ROWS = 500
 
-def get_seriation_map(order_method):
-    smap = get_smap()
-    df = smap.get_feature_df()
 
-    order = order_method.get_order(df)
-    df['order'] = order
-    df = df.sort_values(by='order')
-    df.drop(['order'], axis=1, inplace=True)
+@lru_cache(maxsize=None)
+def mapbox_token(path='./mapbox.tk'):
+    # Read once, without a token the map uses a style that does not need one
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
 
-    bsu_order = [0 for _ in range(len(order))]
-    for idx, bsu in enumerate(order):
-        bsu_order[bsu] = idx
 
-    geojson = json.loads(smap.regions.to_json())
+@lru_cache(maxsize=None)
+def map_layout():
+    token = mapbox_token()
+    mapbox = {
+        'style': 'mapbox://styles/aldubray/ckkmt2c1x52bj17qt3kqtlxi8' if token else 'carto-positron',
+        'center': {
+            'lat': 50.50000,
+            'lon': 4.441393
+        },
+        'zoom': 7,
+    }
+    if token:
+        mapbox['accesstoken'] = token
+    return go.Layout(mapbox=mapbox, height=800, width=1000)
+
+
+def get_seriation_map(order_method, radius=None, progress=None, dataset=None, sample_rate=None):
+    # Returns the map and heatmap figures as dicts. They are cached by the smap as JSON, keyed by
+    # the radius and the ordering method. With a sample rate, the features are approximated on a
+    # sample of the ids (see Smap.get_feature_df) and ordered by the preview of the method.
+    # progress(fraction, message) is called between the stages, it may raise to stop the computation
+    progress = progress if progress is not None else lambda *_: None
+    progress(0.0, 'Loading the dataset')
+    smap = get_smap(dataset)
+    radius = smap.radius if radius is None else radius
+    if sample_rate is not None and (sample_rate >= 1 or smap.has_feature_df(radius)):
+        sample_rate = None
+    if sample_rate is not None:
+        order_method = order_method.preview()
+    key = (radius, order_method.name, hash_key(order_method.params), smap.geometry_level, sample_rate)
+    figures = smap.figure_cache.get_or_compute(key, lambda: [
+        pio.to_json(fig, validate=False)
+        for fig in build_seriation_map(smap, order_method, radius, progress, sample_rate)])
+    with stage('figure_load'):
+        return tuple(json.loads(fig) for fig in figures)
+
 
-    fig = go.Figure()
+def build_seriation_map(smap, order_method, radius, progress, sample_rate=None):
+    progress(0.0, 'Computing the features')
+    with stage('feature_df', len(smap.regions)):
+        df = smap.get_feature_df(radius, sample_rate)
+
+    data = df.drop(columns='region_id')
+    progress(0.3, 'Ordering the regions')
+    order = smap.order_cache.get_order(order_method, data)
+    progress(0.8, 'Drawing the map')
+
+    geojson = smap.get_geojson()
 
     if order_method.clustering:
-        z = [str(x) for x in order]
+        # The order is the cluster of each region
+        z = order
+        rows = np.argsort(order, kind='stable')
+        colorscale = None
         colorbar = {
             'title': 'Cluster',
         }
     else:
+        # The order is the path through the regions, each region is colored by its rank in it
+        z = ranks(order)
+        rows = order
         colorscheme = px.colors.sequential.Rainbow
         colorscheme = [str_to_rgb(x) for i, x in enumerate(colorscheme) if i not in {1,3,6}]
-        distances = [0.0] + [euclidean(df.iloc[order[i-1]], df.iloc[order[i]]) for i in range(1, len(bsu_order))]
-        colorscale = get_colorscale(distances, colorscheme)
+        with stage('colorscale', len(order)):
+            colorscale = get_colorscale(path_distances(data.to_numpy(), order), colorscheme)
         colorbar = {
             'title': 'Order'
         }
+    # The feature dataframe is cached by the smap, it is only read
+    df = df.iloc[rows]
+    z = z[rows]
 
-    fig.add_trace(go.Choroplethmapbox(geojson=geojson, locations=df.region_id,
-                                      z=order,
-                                      colorscale=colorscale,
-                                      marker_opacity=0.8, marker_line_width=0,
-                                      colorbar=colorbar))
-    fig.update_layout(mapbox={
-        'accesstoken': open('./mapbox.tk').read(),
-        'style': 'mapbox://styles/aldubray/ckkmt2c1x52bj17qt3kqtlxi8',
-        'center': {
-            'lat': 50.50000,
-            'lon': 4.441393
-        },
-    },
-                      mapbox_zoom=7,
-                      height=800,
-                      width=1000,
-                      )
-
-
-    scaler = QuantileTransformer()
-    feats = []
-    for f in smap.features:
-        if f.categorical:
-            for v in f.values:
-                feats.append(v)
-        else:
-            feats.append(f.name)
-    hm = go.Figure(go.Heatmap(z=scaler.fit_transform(df[feats]),
-                              x=feats,
-                              colorscale='Greys'))
+    with stage('map_figure', len(df)):
+        fig = go.Figure(go.Choroplethmapbox(geojson=geojson, locations=df.region_id,
+                                            z=z,
+                                            colorscale=colorscale,
+                                            marker_opacity=0.8, marker_line_width=0,
+                                            colorbar=colorbar),
+                        layout=map_layout())
+
+    with stage('heatmap', len(df)):
+        feats = []
+        for f in smap.features:
+            if f.categorical:
+                for v in f.values:
+                    feats.append(v)
+            else:
+                feats.append(f.name)
+        # Each feature is mapped to the quantile of its value among the regions
+        values = df[feats].rank(pct=True).to_numpy()
+        y = np.arange(len(df))
+        if len(df) > HEATMAP_ROWS:
+            starts = np.linspace(0, len(df), HEATMAP_ROWS, endpoint=False).astype(int)
+            values = np.add.reduceat(values, starts, axis=0) / np.diff(np.append(starts, len(df)))[:, None]
+            y = starts
+        hm = go.Figure(go.Heatmap(z=values,
+                                  x=feats,
+                                  y=y,
+                                  colorscale='Greys'))
     return fig, hm
@@ -0,0 +1,42 @@
+import numpy as np
+import shapely
+from scipy.spatial import cKDTree
+
+from smap.aggregation import neighbors_matrix
+
+
+class NeighborFinder:
+
+    methods = ['exact', 'centroid']
+
+    def __init__(self, regions, method='exact', crs=None):
+        if method not in self.methods:
+            raise ValueError(f"Unknown neighbor search method '{method}', expected one of {self.methods}")
+        self.method = method
+        # Distances are computed in a metric CRS, by default the UTM zone of the regions
+        self.crs = crs if crs is not None else regions.estimate_utm_crs()
+        projected = regions.geometry.to_crs(self.crs)
+        self._n_regions = len(regions)
+        if method == 'exact':
+            self._geometries = np.asarray(projected.values)
+            self._tree = shapely.STRtree(self._geometries)
+        else:
+            centroids = projected.centroid
+            self._tree = cKDTree(np.column_stack([centroids.x, centroids.y]))
+
+    def within(self, radius):
+        # Returns the (region x region) neighbors matrix of the regions within radius km of each
+        # other. A radius of 0 means that the neighborhood of a region is the region itself.
+        if radius == 0:
+            identity = np.arange(self._n_regions)
+            return neighbors_matrix(identity, identity, self._n_regions)
+        if self.method == 'exact':
+            # The tree returns the candidates whose bounding box is close enough, and only for
+            # them the exact distance between the polygons is checked
+            left, right = self._tree.query(self._geometries, predicate='dwithin', distance=radius*1000)
+        else:
+            pairs = self._tree.query_pairs(radius*1000, output_type='ndarray')
+            identity = np.arange(self._n_regions)
+            left = np.concatenate([pairs[:, 0], pairs[:, 1], identity])
+            right = np.concatenate([pairs[:, 1], pairs[:, 0], identity])
+        return neighbors_matrix(left, right, self._n_regions)
@@ -1,15 +1,64 @@
+import numpy as np
 from scipy.cluster import hierarchy
 from scipy.cluster.hierarchy import optimal_leaf_ordering
+from sklearn.cluster import MiniBatchKMeans
 from sklearn.preprocessing import normalize
 
+from smap.instrumentation import stage
 from smap.ordering import OrderingMethod
+from smap.ordering.TSPSeriation import TSPSeriation
 
 class OLOSeriation(OrderingMethod):
 
     name = "Optimal Leaf Ordering"
     clustering = False
 
+    def __init__(self, max_exact=1000, cluster_size=500, seed=0):
+        # Above max_exact regions the data is first clustered into groups of about cluster_size
+        # regions, the larger the groups the closer the order is to the exact one
+        self.max_exact = max_exact
+        self.cluster_size = cluster_size
+        self.seed = seed
+
+    def preview(self):
+        # The clustering and the optimal leaf orderings are replaced by the TSP heuristic
+        return TSPSeriation().preview()
+
     def get_order(self, data):
         norm_data = normalize(data, norm='l2')
-        z = hierarchy.ward(norm_data)
-        return hierarchy.leaves_list(optimal_leaf_ordering(z, norm_data))
+        return self._order(norm_data)
+
+    def _exact_order(self, data):
+        if len(data) <= 2:
+            return np.arange(len(data))
+        with stage('olo.exact', len(data)):
+            z = hierarchy.ward(data)
+            return hierarchy.leaves_list(optimal_leaf_ordering(z, data))
+
+    def _order(self, data):
+        if len(data) <= self.max_exact:
+            return self._exact_order(data)
+
+        n_clusters = int(np.ceil(len(data) / self.cluster_size))
+        with stage('olo.clustering', len(data)):
+            kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=self.seed, n_init=3,
+                                     batch_size=max(1024, 4*n_clusters)).fit(data)
+        labels = kmeans.labels_
+        if len(np.unique(labels)) == 1:
+            # The regions can not be told apart
+            return np.arange(len(data))
+
+        # The clusters are ordered by their centers, then each cluster is ordered on its own and
+        # flipped if needed so that it starts close to where the previous one ended
+        order = list()
+        for c in self._order(kmeans.cluster_centers_):
+            members = np.flatnonzero(labels == c)
+            if len(members) == 0:
+                continue
+            members = members[self._order(data[members])]
+            if len(order) != 0:
+                last = data[order[-1][-1]]
+                if np.linalg.norm(last - data[members[-1]]) < np.linalg.norm(last - data[members[0]]):
+                    members = members[::-1]
+            order.append(members)
+        return np.concatenate(order)
@@ -1,14 +1,36 @@
-from minisom import MiniSom
-
-from smap.ordering import OrderingMethod
+from smap.cache import LRUCache
+from smap.instrumentation import stage
+from smap.ordering import OrderingMethod, fingerprint
+from smap.ordering.som import BatchSOM
 
 class SOMClustering(OrderingMethod):
 
     name = "Self-Organizing Maps"
     clustering = True
 
+    def __init__(self, grid=(20, 1), epochs=20, batch_size=64, sigma=0.6, learning_rate=0.5, seed=0, cache_size=16):
+        self.grid = grid
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.sigma = sigma
+        self.learning_rate = learning_rate
+        self.seed = seed
+        # Trained maps per feature matrix, i.e. per radius and set of features
+        self._soms = LRUCache(cache_size, name='soms')
+        self._preview = None
+
+    def preview(self):
+        # A tenth of the epochs
+        if self._preview is None:
+            self._preview = SOMClustering(self.grid, max(1, self.epochs // 10), self.batch_size, self.sigma,
+                                          self.learning_rate, self.seed, self._soms.max_items)
+        return self._preview
+
     def get_order(self, data):
-        l = data.values.tolist()
-        som = MiniSom(20, 1, len(data[0]), sigma=0.6)
-        som.train(data, 1000)
-        return [som.winner(x)[0] for x in l]
+        som = self._soms.get_or_compute(fingerprint(data), lambda: self._fit(data))
+        with stage('som.winners', len(data)):
+            return som.winners(data)
+
+    def _fit(self, data):
+        with stage('som.fit', len(data)):
+            return BatchSOM(self.grid, self.sigma, self.learning_rate, self.epochs, self.batch_size, self.seed).fit(data)
@@ -1,9 +1,15 @@
 import subprocess
 
-from scipy.spatial.distance import pdist, squareform
+from scipy.spatial.distance import pdist
 from sklearn.preprocessing import normalize
 
+from smap.instrumentation import stage
 from smap.ordering import OrderingMethod
+from smap.ordering import tsp
+from smap.ordering.concorde import ConcordeRunner
+
+# Time budget (in seconds) of the heuristic used for previews
+PREVIEW_TIME_BUDGET = 0.5
 
 
 class TSPSeriation(OrderingMethod):
@@ -11,35 +17,38 @@ class TSPSeriation(OrderingMethod):
     name = "TSP based Seriation"
     clustering = False
 
+    solvers = ['auto', 'concorde', 'heuristic']
+
+    def __init__(self, solver='auto', time_budget=10.0, n_candidates=10, concorde_timeout=60.0):
+        # 'concorde' calls the external concorde solver, 'heuristic' runs the in-process solver
+        # (nearest neighbor then 2-opt/Or-opt moves for at most time_budget seconds) and 'auto' uses
+        # concorde if it is installed and falls back on the heuristic if it times out
+        if solver not in self.solvers:
+            raise ValueError(f"Unknown TSP solver '{solver}', expected one of {self.solvers}")
+        self.solver = solver
+        self.time_budget = time_budget
+        self.n_candidates = n_candidates
+        self._concorde = ConcordeRunner(timeout=concorde_timeout)
+
+    def preview(self):
+        # The heuristic with a short time budget
+        return TSPSeriation('heuristic', PREVIEW_TIME_BUDGET, self.n_candidates)
+
     def get_order(self, data):
+        return self.solve(data)[0]
+
+    def solve(self, data, init=None):
         norm_data = normalize(data, norm='l2')
-        dist = squareform(pdist(norm_data))
-        self._write_tsp_file(dist)
-        subprocess.call('concorde problem.tsp', shell=True)
-        return self._get_tsp_sol()
-
-    def _write_tsp_file(self, distance_matrix):
-        with open('problem.tsp', 'w') as f:
-            f.write('NAME : seriation\n')
-            f.write('TYPE: TSP\n')
-            f.write(f'DIMENSION: {len(distance_matrix) + 1}\n')
-            f.write('EDGE_WEIGHT_TYPE: EXPLICIT\n')
-            f.write('EDGE_WEIGHT_FORMAT: FULL_MATRIX\n')
-            f.write('EDGE_WEIGHT_SECTION\n')
-            f.write(' ' + ' '.join(['0' for _ in range(len(distance_matrix) + 1)]))
-            f.write('\n')
-            for row in distance_matrix:
-                f.write(' 0 ' + ' '.join([str(int(x*1000)) for x in row]))
-                f.write('\n')
-            f.write('EOF\n')
-
-    def _get_tsp_sol(self):
-        order = list()
-        with open('problem.sol', 'r') as f:
-            first = True
-            for line in f:
-                if first:
-                    first = False
-                    continue
-                order += [int(x) - 1 for x in line.rstrip().split(' ') if int(x) != 0]
-        return order
+        if self.solver == 'concorde' or (self.solver == 'auto' and self._concorde.available):
+            try:
+                with stage('tsp.concorde', len(norm_data)):
+                    return self._concorde.solve(pdist(norm_data), len(norm_data)), True
+            except subprocess.TimeoutExpired:
+                if self.solver == 'concorde':
+                    raise
+
+        # Most of the time only the radius changed since the previous request, the previous order
+        # of the same regions is then a good starting point. The result depends on that order and
+        # on the time budget, it is not reproducible.
+        with stage('tsp.heuristic', len(norm_data)):
+            return tsp.solve(norm_data, self.time_budget, self.n_candidates, init), False
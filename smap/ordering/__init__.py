@@ -1,4 +1,19 @@
 from abc import ABCMeta, abstractmethod
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from smap.cache import LRUCache, hash_key
+from smap.instrumentation import count, stage
+
+
+def fingerprint(data):
+    # Identifies a feature matrix by its columns and its values
+    columns = [str(c) for c in data.columns] if isinstance(data, pd.DataFrame) else None
+    values = np.ascontiguousarray(np.asarray(data, dtype=float))
+    return hash_key(columns, values.shape, hashlib.sha1(values.tobytes()).hexdigest())
 
 class OrderingMethod(metaclass=ABCMeta):
 
@@ -18,3 +33,68 @@ class OrderingMethod(metaclass=ABCMeta):
     @abstractmethod
     def get_order(self, data) -> list[int]:
         pass
+
+    def solve(self, data, init=None):
+        # Used by the order cache, init is the previous order of the same regions computed by
+        # this method, that it may start from. Most methods ignore it. Returns the order and
+        # whether it only depends on the data and the parameters, only such orders are stored on
+        # disk.
+        return self.get_order(data), True
+
+    def preview(self):
+        # A cheaper method giving a similar order, used for the maps of approximate features
+        return self
+
+    @property
+    def params(self) -> dict:
+        # The public attributes set by the constructor
+        return {k: v for k, v in vars(self).items() if not k.startswith('_')}
+
+
+class OrderCache:
+
+    def __init__(self, max_items=64, cache_dir=None, max_files=1024):
+        # Orders are kept in memory and, if a directory is given, on disk where the least recently
+        # written are removed above max_files
+        self.cache_dir = cache_dir
+        self.max_files = max_files
+        self._orders = LRUCache(max_items, name='orders')
+        # Last order computed by each method (and parameters, e.g. a preview does not start the
+        # method it previews). A cache belongs to one smap so they are orders of the same regions.
+        self._last = dict()
+
+    def get_order(self, method, data):
+        key = hash_key(method.name, method.params, fingerprint(data))
+        return self._orders.get_or_compute(key, lambda: self._load_or_compute(key, method, data))
+
+    def clear(self):
+        self._orders.clear()
+
+    def _load_or_compute(self, key, method, data):
+        filename = os.path.join(self.cache_dir, f'{key}.npy') if self.cache_dir is not None else None
+        if filename is not None and os.path.exists(filename):
+            count('orders disk hit')
+            return np.load(filename)
+        last = hash_key(method.name, method.params)
+        init = self._last.get(last)
+        with stage(f'ordering[{method.name}]', len(data)):
+            order, reproducible = method.solve(data, init if init is not None and len(init) == len(data) else None)
+        order = np.asarray(order)
+        self._last[last] = order
+        if filename is not None and reproducible:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(f'{filename}.tmp', 'wb') as f:
+                np.save(f, order)
+            os.replace(f'{filename}.tmp', filename)
+            self._prune()
+        return order
+
+    def _prune(self):
+        files = [os.path.join(self.cache_dir, x) for x in os.listdir(self.cache_dir) if x.endswith('.npy')]
+        if len(files) > self.max_files:
+            files.sort(key=os.path.getmtime)
+            for filename in files[:len(files) - self.max_files]:
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,59 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+
+
+class ConcordeRunner:
+
+    def __init__(self, executable='concorde', timeout=None, scale=1000):
+        # The distances are multiplied by scale and rounded since concorde only handles integers
+        self.executable = executable
+        self.timeout = timeout
+        self.scale = scale
+
+    @property
+    def available(self):
+        return shutil.which(self.executable) is not None
+
+    def solve(self, distances, n):
+        # Shortest Hamiltonian path through n points given their condensed distance matrix (as
+        # returned by pdist). A dummy node at distance 0 from all the others is added and the
+        # optimal tour is cut at that node.
+        #
+        # Each call works in its own temporary directory, so that several calls can run at the
+        # same time, and raises subprocess.TimeoutExpired if the solver takes too long.
+        if n <= 2:
+            return np.arange(n)
+        with tempfile.TemporaryDirectory(prefix='smap-concorde-') as tmp:
+            problem = os.path.join(tmp, 'problem.tsp')
+            solution = os.path.join(tmp, 'problem.sol')
+            self._write_problem(problem, distances, n)
+            subprocess.run([self.executable, '-x', '-o', solution, problem], cwd=tmp, timeout=self.timeout,
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            return self._read_solution(solution)
+
+    def _write_problem(self, filename, distances, n):
+        # The upper triangle of the matrix, row by row, is the condensed matrix preceded by the
+        # (zero) distances of the dummy node. It is written at once by numpy.
+        with open(filename, 'w') as f:
+            f.write('NAME : seriation\n')
+            f.write('TYPE: TSP\n')
+            f.write(f'DIMENSION: {n + 1}\n')
+            f.write('EDGE_WEIGHT_TYPE: EXPLICIT\n')
+            f.write('EDGE_WEIGHT_FORMAT: UPPER_ROW\n')
+            f.write('EDGE_WEIGHT_SECTION\n')
+            f.flush()
+            np.zeros(n, dtype=np.int64).tofile(f, sep=' ')
+            f.write('\n')
+            f.flush()
+            np.rint(np.asarray(distances) * self.scale).astype(np.int64).tofile(f, sep=' ')
+            f.write('\nEOF\n')
+
+    def _read_solution(self, filename):
+        # First the number of nodes then the tour, the path starts right after the dummy node
+        tour = np.fromfile(filename, dtype=np.int64, sep=' ')[1:]
+        start = np.flatnonzero(tour == 0)[0]
+        return np.concatenate([tour[start + 1:], tour[:start]]) - 1
@@ -0,0 +1,43 @@
+import numpy as np
+
+
+class BatchSOM:
+
+    def __init__(self, grid=(20, 1), sigma=0.6, learning_rate=0.5, epochs=20, batch_size=64, seed=0):
+        self.grid = grid
+        self.sigma = sigma
+        self.learning_rate = learning_rate
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.seed = seed
+        self.weights = None
+        # Squared distances between the units on the grid
+        coords = np.indices(grid).reshape(2, -1).T
+        self._grid_dist = ((coords[:, None, :] - coords[None, :, :])**2).sum(axis=-1)
+
+    def fit(self, data):
+        # Mini-batch training: every sample of a batch moves the units towards it, weighted by a
+        # gaussian of their distance on the grid to its best matching unit. The radius and the
+        # learning rate decay over the iterations as in MiniSom.
+        data = np.asarray(data, dtype=float)
+        rng = np.random.default_rng(self.seed)
+        n_units = self._grid_dist.shape[0]
+        self.weights = data[rng.choice(len(data), n_units, replace=len(data) < n_units)].copy()
+
+        n_batches = int(np.ceil(len(data) / self.batch_size))
+        total = self.epochs * n_batches
+        for epoch in range(self.epochs):
+            perm = rng.permutation(len(data))
+            for b in range(n_batches):
+                batch = data[perm[b*self.batch_size:(b+1)*self.batch_size]]
+                decay = 1 / (1 + (epoch*n_batches + b) / (total / 2))
+                sigma = self.sigma * decay
+                h = np.exp(-self._grid_dist[self.winners(batch)] / (2 * sigma**2))
+                self.weights += self.learning_rate * decay * (h.T @ batch - h.sum(axis=0)[:, None] * self.weights) / len(batch)
+        return self
+
+    def winners(self, data):
+        # Index (on the flattened grid) of the best matching unit of every sample
+        data = np.asarray(data, dtype=float)
+        dist = (self.weights**2).sum(axis=1)[None, :] - 2 * data @ self.weights.T
+        return np.argmin(dist, axis=1)
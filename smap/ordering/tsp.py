@@ -0,0 +1,161 @@
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Shortest Hamiltonian path heuristics on points of a feature space. The path is stored padded
+# with a sentinel (-1) at both ends, the distance to the sentinel being 0, so that the moves at
+# the extremities of the path need no special case.
+
+
+def solve(data, time_budget=10.0, n_candidates=10, init=None):
+    data = np.asarray(data, dtype=float)
+    if len(data) <= 3:
+        return np.arange(len(data)) if init is None else np.asarray(init)
+    deadline = time.perf_counter() + time_budget
+    candidates = candidate_lists(data, n_candidates)
+    path = np.asarray(init) if init is not None else nearest_neighbor_path(data, candidates)
+
+    padded = np.concatenate([[-1], path, [-1]])
+    while time.perf_counter() < deadline:
+        if _two_opt(data, padded, candidates):
+            continue
+        if not _or_opt(data, padded, candidates):
+            break
+    return padded[1:-1]
+
+
+def path_length(data, path):
+    return np.linalg.norm(np.diff(np.asarray(data)[path], axis=0), axis=1).sum()
+
+
+def candidate_lists(data, k):
+    k = min(k, len(data) - 1)
+    _, neighbors = cKDTree(data).query(data, k + 1)
+    return neighbors[:, 1:]
+
+
+def nearest_neighbor_path(data, candidates):
+    # Starts from the point the farthest from the center, the ends of a path tend to be extreme
+    # points. The next point is the closest unvisited candidate, or the closest unvisited point
+    # when all the candidates are already visited.
+    n = len(data)
+    visited = np.zeros(n, dtype=bool)
+    path = np.empty(n, dtype=int)
+    current = np.argmax(np.linalg.norm(data - data.mean(axis=0), axis=1))
+    for i in range(n):
+        path[i] = current
+        visited[current] = True
+        if i == n - 1:
+            break
+        free = candidates[current][~visited[candidates[current]]]
+        if len(free) != 0:
+            current = free[0]
+        else:
+            rest = np.flatnonzero(~visited)
+            current = rest[np.argmin(np.linalg.norm(data[rest] - data[current], axis=1))]
+    return path
+
+
+def _dist(data, a, b):
+    d = np.linalg.norm(data[a] - data[b], axis=-1)
+    return np.where((a < 0) | (b < 0), 0.0, d)
+
+
+def _positions(padded):
+    pos = np.empty(len(padded) - 2, dtype=int)
+    pos[padded[1:-1]] = np.arange(1, len(padded) - 1)
+    return pos
+
+
+def _two_opt(data, p, candidates, max_moves=1000):
+    # Reversing p[t+1..u] replaces the edges (p[t], p[t+1]) and (p[u], p[u+1]) by (p[t], p[u]) and
+    # (p[t+1], p[u+1]). For each point and each of its candidates, the two moves creating an edge
+    # between them are evaluated at once, then the best non overlapping improving moves are applied.
+    pos = _positions(p)
+    a = np.repeat(np.arange(len(candidates)), candidates.shape[1])
+    lo = np.minimum(pos[a], pos[candidates.ravel()])
+    hi = np.maximum(pos[a], pos[candidates.ravel()])
+    t = np.concatenate([lo, lo - 1])
+    u = np.concatenate([hi, hi - 1])
+    valid = u >= t + 2
+    t, u = t[valid], u[valid]
+
+    delta = _dist(data, p[t], p[u]) + _dist(data, p[t + 1], p[u + 1]) -\
+        _dist(data, p[t], p[t + 1]) - _dist(data, p[u], p[u + 1])
+    improving = np.flatnonzero(delta < -1e-12)
+    if len(improving) == 0:
+        return False
+
+    used = np.zeros(len(p), dtype=bool)
+    applied = 0
+    for i in improving[np.argsort(delta[improving])]:
+        if used[t[i]:u[i] + 2].any():
+            continue
+        used[t[i]:u[i] + 2] = True
+        p[t[i] + 1:u[i] + 1] = p[t[i] + 1:u[i] + 1][::-1].copy()
+        applied += 1
+        if applied == max_moves:
+            break
+    return True
+
+
+def _or_opt(data, p, candidates, max_length=3, max_moves=1000):
+    # Moves a segment of 1 to max_length points, one end of which (a) is a point and the other end
+    # (o) is max_length-1 points before or after it, next to a candidate c of a: either after c
+    # (c, a, ..., o) or before c (o, ..., a, c). The segments can be reversed by the move.
+    pos = _positions(p)
+    n = len(p) - 2
+    k = candidates.shape[1]
+    moves = list()
+    for length in range(1, max_length + 1):
+        for direction in [1, -1] if length > 1 else [1]:
+            a = np.repeat(np.arange(len(candidates)), k)
+            c = candidates.ravel()
+            s = pos[a]
+            e = s + direction * (length - 1)
+            first, last = np.minimum(s, e), np.maximum(s, e)
+            valid = (first >= 1) & (last <= n)
+            a, c, s, e, first, last = a[valid], c[valid], s[valid], e[valid], first[valid], last[valid]
+            o = p[e]
+            q = pos[c]
+            removal = _dist(data, p[first - 1], p[last + 1]) -\
+                _dist(data, p[first - 1], p[first]) - _dist(data, p[last], p[last + 1])
+            for after in [True, False]:
+                if after:
+                    ok = (q < first - 1) | (q > last)
+                    insertion = _dist(data, c, a) + _dist(data, o, p[q + 1]) - _dist(data, c, p[q + 1])
+                else:
+                    ok = (q < first) | (q > last + 1)
+                    insertion = _dist(data, p[q - 1], o) + _dist(data, a, c) - _dist(data, p[q - 1], c)
+                delta = removal + insertion
+                keep = ok & (delta < -1e-12)
+                moves.append(np.column_stack([delta[keep], s[keep], e[keep], q[keep],
+                                              np.full(keep.sum(), after)]))
+    moves = np.concatenate(moves)
+    if len(moves) == 0:
+        return False
+
+    # The moves whose surroundings do not overlap are applied together by giving the moved points
+    # fractional positions in the gap where they are inserted
+    keys = np.arange(len(p), dtype=float)
+    used = np.zeros(len(p), dtype=bool)
+    applied = 0
+    for delta, s, e, q, after in moves[np.argsort(moves[:, 0])]:
+        s, e, q = int(s), int(e), int(q)
+        first, last = min(s, e), max(s, e)
+        gap = slice(q, q + 2) if after else slice(q - 1, q + 1)
+        if used[first - 1:last + 2].any() or used[gap].any():
+            continue
+        used[first - 1:last + 2] = True
+        used[gap] = True
+        segment = np.arange(s, e + (1 if e >= s else -1), 1 if e >= s else -1)
+        start = q if after else q - 1
+        if not after:
+            segment = segment[::-1]
+        keys[segment] = start + np.arange(1, len(segment) + 1) / (len(segment) + 1)
+        applied += 1
+        if applied == max_moves:
+            break
+    p[:] = p[np.argsort(keys, kind='stable')]
+    return True
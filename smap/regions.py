@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import shapely
+
+
+class RegionIndex:
+
+    def __init__(self, regions, labels=None, cells_per_region=256, max_cells=2**22, batch_size=2**18):
+        # Locates points in the regions and in the labelled areas at once, as the sjoin 'within' of
+        # both would do. A grid covering the regions is built once: the cells that are strictly
+        # inside a single polygon (or outside all of them) give the answer for all their points,
+        # only the points in the cells crossed by a border are checked against the polygons. The
+        # cells are classified by batches of batch_size boxes to bound the memory.
+        self._regions = np.asarray(regions.geometry.values)
+        self._region_tree = shapely.STRtree(self._regions)
+        self._labels = np.asarray(labels.geometry.values) if labels is not None else None
+        self._label_tree = shapely.STRtree(self._labels) if labels is not None else None
+
+        self.bounds = regions.total_bounds
+        width, height = self.bounds[2] - self.bounds[0], self.bounds[3] - self.bounds[1]
+        n_cells = min(max_cells, cells_per_region * len(regions))
+        size = np.sqrt(width * height / n_cells) if width * height > 0 else max(width, height, 1.0)
+        self.shape = (max(1, int(np.ceil(width / size))), max(1, int(np.ceil(height / size))))
+        self._cell_size = (max(width, 1e-12) / self.shape[0], max(height, 1e-12) / self.shape[1])
+
+        n_cells = self.shape[0] * self.shape[1]
+        self._region_cells = np.empty(n_cells, dtype=np.int32)
+        self._label_cells = np.full(n_cells, -1, dtype=np.int32)
+        for start in range(0, n_cells, batch_size):
+            end = min(start + batch_size, n_cells)
+            cells = self._cells(start, end)
+            self._region_cells[start:end] = self._classify(cells, self._region_tree, self._regions)
+            if labels is not None:
+                self._label_cells[start:end] = self._classify(cells, self._label_tree, self._labels)
+
+    def _cells(self, start, end):
+        # Boxes of the cells start to end, numbered column by column. The cells are slightly
+        # enlarged so that a point put in a cell by a rounded division is always in the box that
+        # was classified.
+        ix, iy = np.divmod(np.arange(start, end), self.shape[1])
+        x0 = self.bounds[0] + ix * self._cell_size[0]
+        y0 = self.bounds[1] + iy * self._cell_size[1]
+        ex, ey = 1e-6 * self._cell_size[0], 1e-6 * self._cell_size[1]
+        return shapely.box(x0 - ex, y0 - ey, x0 + self._cell_size[0] + ex, y0 + self._cell_size[1] + ey)
+
+    @staticmethod
+    def _classify(cells, tree, geoms):
+        # Polygon of each cell: its code if the cell is strictly inside that polygon only, -1 if
+        # the cell does not touch any polygon and -2 if it has to be checked point by point
+        c, g = tree.query(cells, predicate='intersects')
+        n = np.bincount(c, minlength=len(cells))
+        codes = np.full(len(cells), -2)
+        codes[n == 0] = -1
+        single = n[c] == 1
+        c, g = c[single], g[single]
+        inside = shapely.contains_properly(geoms[g], cells[c])
+        codes[c[inside]] = g[inside]
+        return codes
+
+    def locate(self, lon, lat):
+        # Returns, for each (point, region, label) match, the position of the point, the region
+        # and the label (-1 if none). The points outside the regions are dropped, the matches are
+        # sorted by point.
+        lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+        ix = np.floor((lon - self.bounds[0]) / self._cell_size[0])
+        iy = np.floor((lat - self.bounds[1]) / self._cell_size[1])
+        outside = ~((lon >= self.bounds[0]) & (lon <= self.bounds[2]) & (lat >= self.bounds[1]) & (lat <= self.bounds[3]))
+        # The points on the bounds of the regions may fall just outside the grid, they are checked
+        off_grid = ~outside & ((ix < 0) | (ix >= self.shape[0]) | (iy < 0) | (iy >= self.shape[1]))
+        cell = np.clip(np.nan_to_num(ix), 0, self.shape[0] - 1).astype(np.int64) * self.shape[1] +\
+            np.clip(np.nan_to_num(iy), 0, self.shape[1] - 1).astype(np.int64)
+        region = np.where(outside, -1, np.where(off_grid, -2, self._region_cells[cell]))
+        label = self._label_cells[cell]
+
+        known = (region >= 0) & (label != -2)
+        points = np.flatnonzero(known)
+        regions, labels = region[points], label[points]
+
+        check = np.flatnonzero((region == -2) | ((region >= 0) & (label == -2)))
+        if len(check) != 0:
+            p, r, l = self._exact(shapely.points(lon[check], lat[check]))
+            points = np.concatenate([points, check[p]])
+            regions = np.concatenate([regions, r])
+            labels = np.concatenate([labels, l])
+
+        order = np.argsort(points, kind='stable')
+        return points[order], regions[order], labels[order]
+
+    def _exact(self, points):
+        p, r = self._region_tree.query(points, predicate='within')
+        if self._label_tree is None:
+            return p, r, np.full(len(p), -1)
+        lp, l = self._label_tree.query(points, predicate='within')
+        if len(np.unique(lp)) == len(lp):
+            label = np.full(len(points), -1)
+            label[lp] = l
+            return p, r, label[p]
+        # Some points are in several labelled areas, each (point, region) pair gets one row per label
+        matches = pd.DataFrame({'p': p, 'r': r}).merge(pd.DataFrame({'p': lp, 'l': l}), on='p', how='left')
+        return matches['p'].to_numpy(), matches['r'].to_numpy(), matches['l'].fillna(-1).to_numpy(dtype=int)
@@ -0,0 +1,36 @@
+import threading
+
+from smap.cache import LRUCache
+
+
+class SmapRegistry:
+
+    def __init__(self):
+        # Datasets are registered with a function building their smap, which is called on first use
+        self._builders = dict()
+        self._smaps = LRUCache()
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._builders
+
+    def names(self):
+        return list(self._builders)
+
+    def register(self, name, build):
+        with self._lock:
+            self._builders[name] = build
+            self._smaps.pop(name)
+
+    def unregister(self, name):
+        with self._lock:
+            self._builders.pop(name, None)
+            self._smaps.pop(name)
+
+    def get(self, name):
+        if name not in self._builders:
+            raise ValueError(f'Unknown dataset {name}, expected one of {self.names()}')
+        return self._smaps.get_or_compute(name, self._builders[name])
+
+    def loaded(self, name):
+        return name in self._smaps
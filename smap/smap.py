@@ -1,11 +1,22 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from dataclasses import dataclass
 import os
+import threading
 
 import pandas as pd
 import geopandas as gpd
 import numpy as np
 
+from smap.aggregation import ChunkAggregator, neighborhood_features
+from smap.cache import LRUCache, file_fingerprint, hash_key, read_table, shared, write_table
 from smap.features import Feature
+from smap.features.pipeline import FeaturePipeline
+from smap.geometry import GeoJSONExport
+from smap.instrumentation import stage
+from smap.neighbors import NeighborFinder
+from smap.ordering import OrderCache
+from smap.registry import SmapRegistry
+from smap.storage import FORMAT as STORAGE_FORMAT, PairFeatures
 
 @dataclass
 class Smap:
@@ -19,160 +30,386 @@ class Smap:
     lat_field: str
     lon_field: str
     timestamp_field: str
+    # Rows read at once, the rows of each id must then be contiguous or ordered by time
+    chunksize: int = None
+    precompute_radii: list[int] = None
+    cache_size: int = 16
+    cache_memory: int = 2**30
+    neighbor_method: str = 'exact'
+    n_jobs: int = 1
+    cache_columns: bool = False
+    cache_orders: bool = False
+    geometry_level: str = 'medium'
+    cache_dir: str = None
 
     def __post_init__(self):
-        self.regions = gpd.read_file(self.regions_file)
+        # The structures that only depend on the regions are shared by the smaps using the same files
+        regions_key = file_fingerprint(self.regions_file)
+        self.regions = shared(['regions', regions_key], lambda: gpd.read_file(self.regions_file))
 
-        self.labelized_regions = gpd.read_file(self.labelized_regions_file) if\
+        self.labelized_regions = shared(['regions', file_fingerprint(self.labelized_regions_file)],
+                                        lambda: gpd.read_file(self.labelized_regions_file)) if\
             self.labelized_regions_file is not None else None
 
         _script_dir = os.path.dirname(os.path.realpath(__file__))
-        self._cache_dir = os.path.join(_script_dir, 'cached')
+        self._cache_dir = self.cache_dir if self.cache_dir is not None else os.path.join(_script_dir, 'cached')
         if not os.path.exists(self._cache_dir):
             os.makedirs(self._cache_dir)
+        self.appended_files = list()
+        self._pipeline = FeaturePipeline(self.features,
+                                         os.path.join(self._cache_dir, 'columns') if self.cache_columns else None)
+        # The part of the smap that the worker processes need to aggregate the trajectories
+        self._aggregator = ChunkAggregator(self.regions, self.labelized_regions, self.regions_file,
+                                           self.labelized_regions_file, self._pipeline, self.id_field,
+                                           self.lat_field, self.lon_field, self.timestamp_field)
         self._compute_pre_dataframe()
 
-        self._last_radius_request = None
+        self._neighbor_finder = shared(['neighbor finder', regions_key, self.neighbor_method],
+                                       lambda: NeighborFinder(self.regions, self.neighbor_method))
+        self._neighbors_cache = shared(['neighbors', regions_key, self.neighbor_method],
+                                       lambda: LRUCache(self.cache_size, self.cache_memory, 'neighbors'))
+        self._features_cache = LRUCache(self.cache_size, self.cache_memory, 'features')
+        self._approximate_cache = LRUCache(self.cache_size, self.cache_memory, 'approximate features')
+        self._geojson = shared(['geojson', regions_key],
+                               lambda: GeoJSONExport(self.regions, self.regions_file, self._cache_dir))
+        self.figure_cache = LRUCache(self.cache_size, self.cache_memory, 'figures')
+        self.order_cache = OrderCache(4*self.cache_size,
+                                      os.path.join(self._cache_dir, 'orders') if self.cache_orders else None)
+        if self.precompute_radii:
+            threading.Thread(target=self._precompute, args=(list(self.precompute_radii),), daemon=True).start()
+
+    def get_geojson(self, level=None):
+        return self._geojson.get(self.geometry_level if level is None else level)
 
     def register_feature(self, f: Feature):
         self.features.append(f)
 
-    def _get_cache_name(self):
+    def _input_files(self):
         l = [self.traj_file, self.regions_file]
         if self.labelized_regions_file is not None:
             l.append(self.labelized_regions_file)
-        l = [os.path.splitext(os.path.basename(x))[0] for x in l]
+        return l
+
+    def _input_key(self, appended_files=None):
+        appended_files = self.appended_files if appended_files is None else appended_files
+        return hash_key([file_fingerprint(x) for x in self._input_files()],
+                        [self.id_field, self.lat_field, self.lon_field, self.timestamp_field],
+                        [file_fingerprint(x) for x in appended_files])
+
+    def _get_cache_name(self, appended_files=None):
+        key = hash_key(self._input_key(appended_files), [f.key for f in self.features], STORAGE_FORMAT)
+        l = [os.path.splitext(os.path.basename(x))[0] for x in self._input_files()]
         l += [f.name for f in self.features]
-        filename = '-'.join(l)
+        filename = '-'.join(l + [key[:16]]) + '.arrow'
         return os.path.join(self._cache_dir, filename)
 
     def _compute_pre_dataframe(self, force=False):
         cached_file = self._get_cache_name()
         if not force and os.path.exists(cached_file):
-            df = pd.read_csv(cached_file)
-            return df
-
-        # TODO: not memory efficient at all... Find a better way?
-        # Maybe I should directly store the dataset as a geojson file?
-        df = pd.read_csv(self.traj_file, parse_dates=[self.timestamp_field])
-        df.sort_values(by=[self.id_field, self.timestamp_field], inplace=True)
-        df['duration'] = (df[self.timestamp_field].shift(-1).fillna(df.loc[len(df)-1, self.timestamp_field]) -\
-                          df[self.timestamp_field])/np.timedelta64(1, 's')
-        switch = [df.loc[i, self.id_field] != df.loc[i+1, self.id_field] for i in range(len(df)-1)] + [False]
-        df['duration'][switch] = 0
-        df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[self.lon_field], df[self.lat_field]))
-        df = gpd.sjoin(df, self.regions, op='within')
-        df.rename(columns={'index_right': 'region_id'}, inplace=True)
-
-        if self.labelized_regions is not None:
-            df = gpd.sjoin(df, self.labelized_regions, op='within', how='left')
-            df.drop(['index_right'], axis=1, inplace=True)
-            df['label'].fillna('', inplace=True)
-
-        df.reset_index(inplace=True)
-        df.drop(['index'], axis=1, inplace=True)
-        if self.labelized_regions is not None:
-            for f in self.features:
-                    f.compute(df, lat=self.lat_field, lon=self.lon_field, predefined_labels=df['label'])
-        else:
-            for f in self.features:
-                    f.compute(df, lat=self.lat_field, lon=self.lon_field)
-
-        cols_to_keep = ['id', 'region_id', 'duration'] + [f.name for f in self.features]
-        df.drop(df.columns.difference(cols_to_keep), axis=1, inplace=True)
-
-        categorical_features = [f for f in self.features if f.categorical]
-        numerical_features = [f.name for f in self.features if not f.categorical]
-
-        # Each numerical feature is averaged per id and per BSU
-        if len(numerical_features) != 0:
-            pre_df = df.groupby(['id', 'region_id']).agg({
-                x: 'mean' for x in numerical_features
-            })
-
-        # Then we handle the catagorical feature separately and merge them afterward
-        to_merge = list()
-        indexed = df.set_index(['id', 'region_id'])
-        for feat in categorical_features:
-            to_merge.append(indexed[[feat.name, 'duration']].pivot_table(
-                values='duration',
-                index=indexed.index,
-                columns=feat.name,
-                aggfunc=sum))
-
-        if len(numerical_features) != 0:
-            pre_df = pd.concat([pre_df] + to_merge, axis=1)
+            with stage('pre_dataframe.load'):
+                self._load_pre_dataframe(cached_file)
+            return
+
+        # Identifies the chunks (and partitions) of the input for the feature columns cache
+        source = hash_key(self._input_key(), self.chunksize, self.n_jobs)[:16]
+        chunks = self._continue_trips(self._read_trajectories(self.traj_file))
+        if self.n_jobs > 1:
+            partials = self._aggregate_parallel(source, chunks)
         else:
-            pre_df = pd.concat(to_merge, axis=1)
-        pre_df.rename(columns={'level_0': 'id', 'level_1': 'region_id'})
-        pre_df.fillna({c: 0.0 for c in pre_df.columns}, inplace=True)
-        pre_df['id'], pre_df['region_id'] = zip(*pre_df.index)
-        self.pre_feature_df = pre_df
+            partials = [partial for i, (boundary, df) in enumerate(chunks)
+                        for partial in self._aggregate_continued(boundary, df, f'{source}-{i}')]
+        self.pre_features = self._finalize_aggregates(partials)
+        self._store_pre_dataframe(cached_file)
+        # Reading it back memory maps its columns, the pages are then shared with the other
+        # processes using the same dataset
+        self._load_pre_dataframe(cached_file)
 
+    def _store_pre_dataframe(self, filename):
+        # The values of the categorical features depend on the data (e.g. the predefined labels)
+        # so they are stored alongside the pairs
+        values = {f.name: list(f.values) for f in self.features if f.categorical}
+        self.pre_features.write(filename, {'values': values})
+        write_table(self._last_fixes_name(filename), self.last_fixes)
 
-    def _compute_features_for_bsus(self, rids):
-        agg_funcs = {}
-        for f in self.features:
-            if f.categorical:
-                for v in f.values:
-                    agg_funcs[v] = sum
-            else:
-                agg_funcs[f.name] = 'mean'
-        sdf = self.pre_feature_df[self.pre_feature_df['region_id'].isin(rids)].groupby('id').agg(agg_funcs)
-        sdf['total'] = 0
+    def _load_pre_dataframe(self, filename):
+        self.pre_features, metadata = PairFeatures.read(filename)
+        self.last_fixes, _ = read_table(self._last_fixes_name(filename))
         for f in self.features:
             if f.categorical:
-                for v in f.values:
-                    sdf['total'] += sdf[v]
+                for v in metadata['values'][f.name]:
+                    if v not in f.values:
+                        f.values.append(v)
+        self._order_values()
 
-        sdf = sdf[sdf['total'] != 0]
+    @property
+    def pre_feature_df(self):
+        # Dense view of the pre-aggregated features, indexed by (id, region_id)
+        return self.pre_features.to_frame(self.regions.index)
 
+    @staticmethod
+    def _last_fixes_name(filename):
+        return f'{os.path.splitext(filename)[0]}-last.arrow'
+
+    def _read_trajectories(self, traj_file):
+        # Without a chunksize the whole file is loaded at once. Otherwise the rows of the last
+        # id of each chunk are carried over to the next one so that the trajectory of an id whose
+        # rows are contiguous is never split. The trips of an id seen again in a later chunk (e.g.
+        # in a file ordered by time) are continued by _continue_trips.
+        if self.chunksize is None:
+            with stage('csv_load') as s:
+                df = pd.read_csv(traj_file, parse_dates=[self.timestamp_field])
+                s['rows'] = len(df)
+            yield df
+            return
+
+        carry = None
+        for chunk in pd.read_csv(traj_file, parse_dates=[self.timestamp_field], chunksize=self.chunksize):
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+            last = chunk[self.id_field] == chunk[self.id_field].iloc[-1]
+            carry = chunk[last]
+            if not last.all():
+                yield chunk[~last].reset_index(drop=True)
+        if carry is not None:
+            yield carry.reset_index(drop=True)
+
+    def _continue_trips(self, chunks, last_fixes=None):
+        # Yields each chunk with the last fixes of its ids that were seen in the previous chunks
+        # (or files), from which their trips continue. The rows of such an id must come after its
+        # last fix, i.e. the file has the rows of each id either contiguous or ordered by time.
+        # The last fix of each id is kept in self.last_fixes for the files appended later.
+        last = last_fixes
+        for df in chunks:
+            boundary = last[last[self.id_field].isin(df[self.id_field].unique())] if last is not None else df.iloc[:0]
+            if len(boundary) > 0:
+                first = df.groupby(self.id_field)[self.timestamp_field].min()
+                early = (first[boundary[self.id_field]].to_numpy() < boundary[self.timestamp_field].to_numpy())
+                if early.any():
+                    raise ValueError(f'The rows of id {boundary[self.id_field].iloc[np.argmax(early)]!r} are neither '
+                                     f'contiguous nor ordered by time, sort the file by id or by time')
+            tails = df.sort_values(self.timestamp_field, kind='mergesort').groupby(self.id_field).tail(1)
+            last = pd.concat([last, tails], ignore_index=True) if last is not None else tails
+            last = last.sort_values(self.timestamp_field, kind='mergesort').groupby(self.id_field).tail(1)
+            yield boundary.reset_index(drop=True), df
+        if last is not None:
+            self.last_fixes = last.reset_index(drop=True)
+
+    def _aggregate_continued(self, boundary, df, fingerprint=None):
+        # The aggregates of the boundary fixes with the chunk minus the ones of the boundary fixes
+        # alone: the contribution a boundary fix had as the end of a trip (which only depends on
+        # the fix itself) is replaced by its contribution with the following points
+        if len(boundary) == 0:
+            return [self._aggregate_chunk(df, fingerprint)]
+        return [self._aggregate_chunk(pd.concat([boundary, df], ignore_index=True), fingerprint),
+                -self._aggregate_chunk(boundary.copy())]
+
+    def _aggregate_parallel(self, source, chunks):
+        # The trajectories are independent so each chunk is split into partitions of ids (by hash)
+        # that are aggregated by a pool of processes. At most two partitions per worker are in
+        # flight to bound the memory.
+        partials = list()
+        values = {f.name: set() for f in self.features if f.categorical}
+
+        def collect(futures):
+            for future in futures:
+                partial, feature_values = future.result()
+                partials.append(partial)
+                for name, vals in feature_values.items():
+                    values[name].update(vals)
+
+        # The region index is built here once for all the workers
+        self._aggregator.region_index()
+        with ProcessPoolExecutor(self.n_jobs, initializer=_init_worker, initargs=(self._aggregator,)) as pool:
+            pending = set()
+            for i, (boundary, df) in enumerate(chunks):
+                def partitions(x):
+                    return pd.util.hash_pandas_object(x[self.id_field], index=False).to_numpy() % self.n_jobs
+                boundaries = dict(list(boundary.groupby(partitions(boundary))))
+                for p, partition in df.groupby(partitions(df)):
+                    if len(pending) >= 2*self.n_jobs:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    if p in boundaries:
+                        # The continued trips, see _aggregate_continued
+                        partition = pd.concat([boundaries[p], partition], ignore_index=True)
+                        pending.add(pool.submit(_aggregate_partition, boundaries[p].reset_index(drop=True),
+                                                None, True))
+                    pending.add(pool.submit(_aggregate_partition, partition, f'{source}-{i}-{p}'))
+            collect(pending)
+
+        # The categorical features may have discovered new values in the workers
         for f in self.features:
             if f.categorical:
-                sdf[f.values] /= sdf['total']
-        row = []
-        for f in self.features:
-            if f.categorical:
-                for v in f.values:
-                    row.append(sdf[v].mean())
-            else:
-                row.append(sdf[f.name].mean())
-        return row
+                f.values.extend(values[f.name].difference(f.values))
+        return partials
 
+    def _aggregate_chunk(self, df, fingerprint=None):
+        return self._aggregator.aggregate(df, fingerprint)
 
-    def get_feature_df(self):
-        if self.radius == self._last_radius_request:
-            return self.feature_df
-        buf_regions = self.regions.copy()
-        buf_regions.geometry = buf_regions.geometry.to_crs('epsg:27700').buffer(self.radius*1000).to_crs(self.regions.crs)
-        op = 'covers' if self.radius == 0 else 'intersects'
-        df = gpd.sjoin(self.regions, buf_regions, op=op).reset_index()
-        df.rename(columns={'index_right': 'neighbors'}, inplace=True)
-        df = df.groupby('index').agg({'neighbors': set})
+    def _finalize_aggregates(self, partials):
+        self._order_values()
+        pre_df = pd.concat(partials).groupby(level=[0, 1]).sum().rename_axis([None, None])
+        pre_df.fillna({c: 0.0 for c in pre_df.columns}, inplace=True)
+        numerical = [f.name for f in self.features if not f.categorical]
+        return PairFeatures.from_frame(pre_df, self.regions.index, numerical, self._categorical_columns())
 
+    def _categorical_columns(self):
+        return [v for f in self.features if f.categorical for v in f.values]
+
+    def _order_values(self):
+        # The values found in the data (e.g. the predefined labels) follow the ones of the feature
+        # class, sorted, whatever the order in which the chunks or the workers found them
+        for f in self.features:
+            if f.categorical:
+                defined = getattr(type(f), 'values', None)
+                defined = defined if isinstance(defined, list) else []
+                f.values[:] = [v for v in defined if v in f.values] + sorted(set(f.values).difference(defined))
+
+    def _compute_features_for_bsus(self, neighbors, sample_rate=None):
         cols = []
+        categorical = []
         for f in self.features:
             if f.categorical:
-                for v in f.values:
-                    cols.append(v)
+                cols += f.values
+                categorical += [True] * len(f.values)
             else:
                 cols.append(f.name)
+                categorical.append(False)
+        pairs = self.pre_features
+        region_codes, id_codes, values = pairs.region_codes, pairs.id_codes, pairs.values(cols)
+        if sample_rate is not None:
+            # Only the pairs of the sampled ids are aggregated, the features are then means over
+            # the sampled ids of each neighborhood
+            keep = pairs.sampled(sample_rate)
+            region_codes, id_codes, values = region_codes[keep], id_codes[keep], values[keep]
+        with stage('neighborhood_features', len(region_codes)):
+            features = neighborhood_features(neighbors, region_codes, id_codes, values, np.array(categorical))
+        if sample_rate is not None:
+            # The neighborhoods without any sampled id are computed on all their ids, they have few
+            missing = np.flatnonzero(np.isnan(features).all(axis=1))
+            if len(missing) != 0:
+                neighbors = neighbors[missing]
+                keep = np.isin(pairs.region_codes, neighbors.indices)
+                with stage('neighborhood_features', keep.sum()):
+                    features[missing] = neighborhood_features(neighbors, pairs.region_codes[keep],
+                                                              pairs.id_codes[keep], pairs.values(cols)[keep],
+                                                              np.array(categorical))
+        return pd.DataFrame(features, columns=cols)
 
-        df[cols] = [self._compute_features_for_bsus(x) for x in df['neighbors']]
-        df.drop(['neighbors'], axis=1, inplace=True)
-        df.reset_index(inplace=True)
-        df.rename(columns={'index': 'region_id'}, inplace=True)
+    def _get_neighbors(self, radius):
+        def compute():
+            with stage('neighbors', len(self.regions)):
+                return self._neighbor_finder.within(radius)
+        return self._neighbors_cache.get_or_compute(radius, compute)
+
+    def _compute_feature_df(self, radius, sample_rate=None):
+        neighbors = self._get_neighbors(radius)
+        df = self._compute_features_for_bsus(neighbors, sample_rate)
+        df.insert(0, 'region_id', self.regions.index)
         df.fillna({c: 0.0 for c in df.columns}, inplace=True)
-        self.feature_df = df
-        self._last_radius_request = self.radius
         return df
 
-smap = None
-def create_smap(traj_file, region_file, poi_file, features, radius=0, id_field='id', lat='lat', lon='lon', timestamp='daytime'):
-    global smap
-    smap = Smap(traj_file, region_file, poi_file, features, radius, id_field, lat, lon, timestamp)
+    def append_trajectories(self, traj_file):
+        # Adds the trajectories of another file to the aggregates. The trip of an id already seen
+        # continues from its last fix: the contribution that fix had as the end of a trip (whose
+        # features only depend on the fix itself) is replaced by its contribution computed with
+        # the new points. Only the cached feature rows of the regions whose neighborhood contains
+        # a modified pair are recomputed.
+        # The file is only part of the inputs once its aggregates are merged
+        appended_files = self.appended_files + [traj_file]
+        values = [list(f.values) for f in self.features if f.categorical]
+        cached_file = self._get_cache_name(appended_files)
+        previous = self.pre_features
+        if os.path.exists(cached_file):
+            self._load_pre_dataframe(cached_file)
+            diff = PairFeatures.concat([self.pre_features, -previous], self._categorical_columns())
+        else:
+            partials = [partial for boundary, df in self._continue_trips(self._read_trajectories(traj_file),
+                                                                          self.last_fixes)
+                        for partial in self._aggregate_continued(boundary, df)]
+            # The partials sum to the difference with the previous aggregates
+            diff = self._finalize_aggregates(partials) if partials else None
+            if diff is not None:
+                self.pre_features = PairFeatures.concat([previous, diff], self._categorical_columns())
+            self._store_pre_dataframe(cached_file)
+            self._load_pre_dataframe(cached_file)
+        self.appended_files = appended_files
+
+        affected = np.zeros(len(self.regions))
+        if diff is not None:
+            affected[diff.region_codes[diff.changed()]] = 1
+        self._update_features(affected)
+        if values != [list(f.values) for f in self.features if f.categorical]:
+            # New categorical values were found, all the heatmaps have a new column
+            self.figure_cache.clear()
+        for key in self.figure_cache.keys():
+            if (self._get_neighbors(key[0]) @ affected).any():
+                self.figure_cache.pop(key)
+
+    def _update_features(self, affected):
+        self._approximate_cache.clear()
+        # The orders are cached by feature matrix so the ones of the modified radii are not hit anymore
+        for radius in self._features_cache.keys():
+            df = self._features_cache.get(radius)
+            if df is None:
+                continue
+            neighbors = self._get_neighbors(radius)
+            rows = np.flatnonzero(neighbors @ affected)
+            if len(rows) == 0:
+                continue
+            features = self._compute_features_for_bsus(neighbors[rows]).fillna(0.0)
+            if list(features.columns) != list(df.columns[1:]):
+                # New categorical values were found, all the rows have a new column
+                self._features_cache.pop(radius)
+                continue
+            df = df.copy()
+            df.iloc[rows, 1:] = features.to_numpy()
+            self._features_cache.put(radius, df)
+
+    def get_feature_df(self, radius=None, sample_rate=None):
+        # With a sample rate below 1, the features are approximated on a sample of the ids. The
+        # exact features are returned instead when they are already computed.
+        radius = self.radius if radius is None else radius
+        if sample_rate is None or sample_rate >= 1 or self.has_feature_df(radius):
+            return self._features_cache.get_or_compute(radius, lambda: self._compute_feature_df(radius))
+        return self._approximate_cache.get_or_compute(
+            (radius, sample_rate), lambda: self._compute_feature_df(radius, sample_rate))
+
+    def has_feature_df(self, radius=None):
+        return (self.radius if radius is None else radius) in self._features_cache
+
+    def _precompute(self, radii):
+        for radius in radii:
+            self.get_feature_df(radius)
+
+_worker_aggregator = None
+def _init_worker(aggregator):
+    global _worker_aggregator
+    _worker_aggregator = aggregator
+
+def _aggregate_partition(df, fingerprint, negate=False):
+    partial = _worker_aggregator.aggregate(df, fingerprint)
+    partial = -partial if negate else partial
+    return partial, {f.name: list(f.values) for f in _worker_aggregator.features if f.categorical}
+
+DEFAULT_DATASET = 'default'
+registry = SmapRegistry()
+
+def create_smap(traj_file, region_file, poi_file, features, radius=0, id_field='id', lat='lat', lon='lon', timestamp='daytime',
+                chunksize=None, precompute_radii=None, cache_size=16, cache_memory=2**30, neighbor_method='exact',
+                n_jobs=1, cache_columns=False, cache_orders=False,
+                geometry_level='medium', cache_dir=None, name=DEFAULT_DATASET, lazy=False):
+    # A lazy smap is only built the first time it is requested
+    registry.register(name, lambda: Smap(traj_file, region_file, poi_file, features, radius, id_field, lat, lon,
+                                         timestamp, chunksize, precompute_radii, cache_size, cache_memory,
+                                         neighbor_method, n_jobs, cache_columns, cache_orders, geometry_level,
+                                         cache_dir))
+    if not lazy:
+        registry.get(name)
 
-def get_smap():
-    if smap is None:
+def get_smap(name=None):
+    if not registry.names():
         raise ValueError("Please first create a smap object")
-    return smap
+    if name is None:
+        name = DEFAULT_DATASET if DEFAULT_DATASET in registry else registry.names()[0]
+    return registry.get(name)
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from scipy import sparse
+
+from smap.cache import read_arrow, write_arrow
+
+# Version of the on-disk layout, part of the cache keys
+FORMAT = 3
+
+
+class PairFeatures:
+
+    def __init__(self, ids, id_codes, region_codes, sums, counts, categorical, categorical_columns):
+        # Pre-aggregated features of the (id, region) pairs, one row per pair. The ids and regions
+        # are integer codes (the regions are positions in the regions file), the numerical
+        # features are float32 sums and int32 counts (dicts name -> array), so that aggregates can
+        # be merged, and the durations of the categorical values, mostly 0, are a float32 CSR matrix.
+        self.ids = ids
+        self.id_codes = id_codes
+        self.region_codes = region_codes
+        self.sums = sums
+        self.counts = counts
+        self.categorical = categorical
+        self.categorical_columns = list(categorical_columns)
+
+    def __len__(self):
+        return len(self.id_codes)
+
+    @property
+    def nbytes(self):
+        return self.id_codes.nbytes + self.region_codes.nbytes + sum(x.nbytes for x in self.sums.values()) +\
+            sum(x.nbytes for x in self.counts.values()) +\
+            self.categorical.data.nbytes + self.categorical.indices.nbytes + self.categorical.indptr.nbytes
+
+    @classmethod
+    def from_frame(cls, df, regions_index, numerical_columns, categorical_columns):
+        # df has an (id, region_id) index, with the sum and the count ('<name> count') of each
+        # numerical feature and one column per categorical value
+        id_codes, ids = pd.factorize(df.index.get_level_values(0))
+        region_codes = regions_index.get_indexer(df.index.get_level_values(1))
+        sums = {c: df[c].to_numpy(dtype=np.float32) for c in numerical_columns}
+        counts = {c: df[f'{c} count'].to_numpy(dtype=np.int32) for c in numerical_columns}
+        categorical = sparse.csr_matrix(df.reindex(columns=categorical_columns, fill_value=0.0)
+                                        .to_numpy(dtype=np.float32))
+        return cls(pd.Index(ids), id_codes.astype(np.int32), region_codes.astype(np.int32), sums, counts,
+                   categorical, categorical_columns)
+
+    @classmethod
+    def concat(cls, parts, categorical_columns):
+        # Sums the aggregates of several parts, the pairs they share are merged. The categorical
+        # matrix stays sparse, its columns are the given ones.
+        ids = pd.Index(pd.unique(np.concatenate([np.asarray(p.ids, dtype=object) for p in parts])))
+        id_codes = np.concatenate([ids.get_indexer(p.ids)[p.id_codes] for p in parts]).astype(np.int64)
+        region_codes = np.concatenate([p.region_codes for p in parts]).astype(np.int64)
+        pairs, inverse = np.unique(id_codes * (region_codes.max(initial=0) + 1) + region_codes, return_inverse=True)
+        first = np.zeros(len(pairs), dtype=np.int64)
+        first[inverse[::-1]] = np.arange(len(inverse))[::-1]
+
+        def total(arrays):
+            return np.bincount(inverse, weights=np.concatenate(arrays), minlength=len(pairs))
+
+        sums = {c: total([p.sums[c] for p in parts]).astype(np.float32) for c in parts[0].sums}
+        counts = {c: np.rint(total([p.counts[c] for p in parts])).astype(np.int32) for c in parts[0].counts}
+        columns = pd.Index(categorical_columns)
+        offsets = np.cumsum([0] + [len(p) for p in parts])
+        blocks = [sparse.coo_matrix(p.categorical) for p in parts]
+        categorical = sparse.csr_matrix(
+            (np.concatenate([b.data.astype(float) for b in blocks]),
+             (inverse[np.concatenate([b.row + o for b, o in zip(blocks, offsets)])],
+              np.concatenate([columns.get_indexer(p.categorical_columns)[b.col] for p, b in zip(parts, blocks)]))),
+            shape=(len(pairs), len(columns)))
+        categorical.eliminate_zeros()
+        used, id_codes = np.unique(id_codes[first], return_inverse=True)
+        return cls(ids[used], id_codes.astype(np.int32), region_codes[first].astype(np.int32), sums, counts,
+                   categorical.astype(np.float32), categorical_columns)
+
+    def __neg__(self):
+        return PairFeatures(self.ids, self.id_codes, self.region_codes, {c: -v for c, v in self.sums.items()},
+                            {c: -v for c, v in self.counts.items()}, -self.categorical, self.categorical_columns)
+
+    def changed(self):
+        # Mask of the pairs with a non zero value, e.g. in a difference of aggregates
+        mask = np.diff(sparse.csr_matrix(self.categorical).indptr) > 0
+        for c in self.sums:
+            mask |= (self.sums[c] != 0) | (self.counts[c] != 0)
+        return mask
+
+    def means(self, name):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts[name] > 0, self.sums[name] / self.counts[name], 0.0).astype(np.float32)
+
+    def to_frame(self, regions_index):
+        df = pd.DataFrame({'id': self.ids[self.id_codes], 'region_id': regions_index[self.region_codes]})
+        for c in self.sums:
+            df[c] = self.means(c)
+        df[self.categorical_columns] = self.categorical.toarray()
+        df.index = pd.MultiIndex.from_arrays([df['id'], df['region_id']], names=[None, None])
+        return df
+
+    def sampled(self, rate):
+        # Mask of the pairs whose id is in a deterministic sample of about rate of the ids, the
+        # same ids are kept from one run to the next
+        hashes = pd.util.hash_array(np.asarray(self.ids), categorize=False)
+        return (hashes < np.uint64(rate * 2.0**64))[self.id_codes]
+
+    def values(self, columns):
+        # Sparse (pair x column) matrix of the given columns, the unknown ones are 0
+        categorical = {c: i for i, c in enumerate(self.categorical_columns)}
+        blocks = list()
+        for c in columns:
+            if c in self.sums:
+                blocks.append(sparse.csr_matrix(self.means(c)[:, None]))
+            elif c in categorical:
+                blocks.append(self.categorical[:, categorical[c]])
+            else:
+                blocks.append(sparse.csr_matrix((len(self), 1), dtype=np.float32))
+        return sparse.hstack(blocks, format='csr')
+
+    def write(self, path, metadata=None):
+        # The categorical matrix is stored as two list columns sharing the CSR row offsets
+        categorical = self.categorical.tocsr()
+        categorical.sort_indices()
+        offsets = pa.array(categorical.indptr.astype(np.int32))
+        table = pa.table({
+            'id': pa.DictionaryArray.from_arrays(pa.array(self.id_codes), pa.array(self.ids.to_numpy())),
+            'region': pa.array(self.region_codes),
+            **{c: pa.array(values) for c, values in self.sums.items()},
+            **{f'{c} count': pa.array(values) for c, values in self.counts.items()},
+            'categorical_columns': pa.ListArray.from_arrays(offsets, pa.array(categorical.indices.astype(np.int32))),
+            'categorical_values': pa.ListArray.from_arrays(offsets, pa.array(categorical.data.astype(np.float32))),
+        })
+        write_arrow(path, table, {**(metadata or {}), 'numerical': list(self.sums),
+                                  'categorical': self.categorical_columns})
+
+    @classmethod
+    def read(cls, path):
+        # The arrays are views on the memory mapped file
+        table, metadata = read_arrow(path)
+
+        def column(name):
+            return table.column(name).combine_chunks()
+
+        ids = column('id')
+        sums = {c: column(c).to_numpy() for c in metadata['numerical']}
+        counts = {c: column(f'{c} count').to_numpy() for c in metadata['numerical']}
+        indices, values = column('categorical_columns'), column('categorical_values')
+        categorical = sparse.csr_matrix((values.values.to_numpy(), indices.values.to_numpy(), values.offsets.to_numpy()),
+                                        shape=(len(table), len(metadata['categorical'])))
+        return cls(pd.Index(ids.dictionary.to_pandas()), ids.indices.to_numpy(), column('region').to_numpy(),
+                   sums, counts, categorical, metadata['categorical']), metadata
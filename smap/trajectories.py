@@ -0,0 +1,24 @@
+import numpy as np
+
+NEXT_LAT = 'next_lat'
+NEXT_LON = 'next_lon'
+
+
+def segment_trips(df, id_field, timestamp_field, lat_field, lon_field):
+    # Sorts the points by trip and computes, for each point, the time until the next point of
+    # the same trip and the position of that next point. The last point of a trip is its own
+    # next point, hence a duration of 0.
+    df.sort_values(by=[id_field, timestamp_field], inplace=True, kind='mergesort')
+    df.reset_index(drop=True, inplace=True)
+
+    ids = df[id_field].to_numpy()
+    trip_end = np.ones(len(df), dtype=bool)
+    trip_end[:-1] = ids[1:] != ids[:-1]
+    next_idx = np.arange(1, len(df) + 1)
+    next_idx[trip_end] = np.flatnonzero(trip_end)
+
+    timestamps = df[timestamp_field].to_numpy()
+    df['duration'] = (timestamps[next_idx] - timestamps) / np.timedelta64(1, 's')
+    df[NEXT_LAT] = df[lat_field].to_numpy()[next_idx]
+    df[NEXT_LON] = df[lon_field].to_numpy()[next_idx]
+    return df